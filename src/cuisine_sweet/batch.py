@@ -0,0 +1,87 @@
+"""
+Batching of remote commands into a single round trip
+
+Ensure modules typically probe the remote state with several small commands
+before deciding what to do. Each ``run()`` is a separate ssh exec, so on 
+high-latency hosts the probes alone dominate the time of an ensure.
+"""
+
+import re
+import uuid
+from fabric.api import run, sudo, hide, puts
+
+
+class BatchResult(str):
+    """
+    The (stripped) output of a batched command, with ``return_code``, ``succeeded`` and ``failed``
+    attributes like the results of fabric's ``run()``.
+    """
+    pass
+
+
+class RemoteBatch(object):
+    """
+    Collects named shell commands, then runs them all as one remote script.
+
+    Usage::
+
+        probes = RemoteBatch()
+        probes.add('home', 'pwd')
+        probes.add('pid', 'cat /tmp/myapp.pid')
+        results = probes.run()
+        if results['pid'].succeeded:
+            print results['home'], results['pid']
+
+    Each command runs in its own subshell (stderr combined with stdout), and does not
+    abort the batch when it fails; check its ``return_code`` / ``failed`` instead.
+    """
+
+    def __init__(self):
+        self.commands = [ ]
+
+    def add(self, name, command):
+        self.commands.append((name, command))
+        return self
+
+    def script(self, marker):
+        lines = [ ]
+        for name, command in self.commands:
+            lines.append("echo '%s BEGIN %s'" % (marker, name))
+            lines.append('( %s ) 2>&1; rc=$?; echo; echo "%s END %s $rc"' % (command, marker, name))
+        return "\n".join(lines)
+
+    def run(self, use_sudo=False):
+        """
+        runs all the commands in one remote script, returns a dict of name -> BatchResult
+        """
+        if not self.commands:
+            return { }
+        marker = 'CUISINE_SWEET_BATCH_%s' % uuid.uuid4().hex
+        puts('batch: %s' % ', '.join([ name for name, command in self.commands ]))
+        with hide('running', 'stdout'):
+            if use_sudo:
+                out = sudo(self.script(marker))
+            else:
+                out = run(self.script(marker))
+        return self.parse(out, marker)
+
+    def parse(self, out, marker):
+        results = { }
+        name = None
+        lines = [ ]
+        for line in out.replace("\r\n", "\n").split("\n"):
+            begin = re.match(r'^%s BEGIN (.*)$' % marker, line)
+            end = re.match(r'^%s END (.*) (\d+)$' % marker, line)
+            if begin:
+                name = begin.group(1)
+                lines = [ ]
+            elif end and name is not None:
+                r = BatchResult("\n".join(lines).strip())
+                r.return_code = int(end.group(2))
+                r.succeeded = r.return_code == 0
+                r.failed = not r.succeeded
+                results[name] = r
+                name = None
+            elif name is not None:
+                lines.append(line)
+        return results
@@ -3,29 +3,32 @@ Fabfile functions for ensuring the state of CPAN modules
 """
 
 import os
+import json
 import pipes
-import cuisine
+import getpass
+import hashlib
 
-from fabric.api import run, puts, env, prefix
-from fabric.colors import green, blue
-from cuisine_sweet.utils import completed_ok
+from fabric.api import run, get, put, puts, env, prefix, abort
+from cuisine_sweet.utils import completed_ok, local_lock
+from cuisine_sweet.ensure import yum
+from cuisine_sweet import facts
+from cuisine_sweet import stash
+
+# where cpanm is stashed from, see cpanm_bin_installed()
+CPANM_URL = 'https://cpanmin.us'
 
 def perl_config_archname():
-    return run("perl -MConfig -e 'print $Config{archname}'")
+    return facts.get('perl_archname')
 
 
 def cpanm_bin_installed(home='/tmp'):
-    cuisine.select_package(option='yum')
-    cuisine.package_ensure('perl-devel')
+    """
+    Ensures that cpanm is in ``home/.deploy/bin``, uploaded from the local stash (see :mod:`cuisine_sweet.stash`),
+    then returns its path. The source and checksum of cpanm can be set in ``env.cpanm_url`` and ``env.cpanm_sha256``.
+    """
+    yum.packages_installed(['perl-devel'])
     binpath = '%s/.deploy/bin' % home
-    cpanm = '%s/cpanm' % binpath
-    if not cuisine.file_exists(cpanm):
-        cuisine.dir_ensure(binpath, recursive=True, mode=755)
-        cuisine.package_ensure('curl')
-        run('curl -kL http://cpanmin.us > %s' % cpanm)
-        run('chmod 755 %s' % cpanm)
-        cuisine.file_exists(cpanm)
-    return cpanm
+    return stash.uploaded(env.get('cpanm_url', CPANM_URL), binpath, sha256=env.get('cpanm_sha256'), name='cpanm', mode=0755)
 
 
 def _exists(module_name, home='/tmp', perlarch=None, locallib='perl5'):
@@ -35,6 +38,30 @@ def _exists(module_name, home='/tmp', perlarch=None, locallib='perl5'):
     return result.endswith('OK')
 
 
+# prints "module<TAB>version" for each module of @ARGV, with a version of "!missing" if it cannot be loaded
+PROBE_MODULES_PL = ('for my $m (@ARGV) { (my $f = "$m.pm") =~ s{::}{/}g; '
+    'if (eval { require $f; 1 }) { my $v = eval { $m->VERSION }; print "$m\\t", (defined $v ? $v : ""), "\\n" } '
+    'else { print "$m\\t!missing\\n" } }')
+
+
+def probe_modules(modules, home='/tmp', perlarch=None, locallib='perl5'):
+    """
+    returns a dict of module name -> version (``''`` if it has none), or None if the module is missing,
+    probing all the ``modules`` in a single perl process
+    """
+    path1 = os.path.join(home, locallib, 'lib', 'perl5')
+    path2 = os.path.join(home, locallib, 'lib', 'perl5', perlarch)
+    result = run("perl -I %s -I %s -e '%s' %s" % (path1, path2, PROBE_MODULES_PL, ' '.join([ pipes.quote(m) for m in modules ])))
+    versions = { }
+    for line in result.splitlines():
+        if '\t' in line:
+            module, version = line.rstrip('\r').split('\t', 1)
+            versions[module] = None if version == '!missing' else version
+    for module in modules:
+        versions.setdefault(module, None)
+    return versions
+
+
 def _do_install(module_name, home='/tmp', cpanm='/tmp/.deploy/bin/cpanm', source=None, locallib='perl5'):
     mod = module_name
     if source is not None:
@@ -46,11 +73,6 @@ def _do_install(module_name, home='/tmp', cpanm='/tmp/.deploy/bin/cpanm', source
 
 
 def _prepare_environment():
-    # --- perl arch name
-    arch = perl_config_archname()
-    if 'perl_arch' not in env:
-        env.perl_arch = { }
-    env.perl_arch[env.host] = arch
     # --- cpanm
     cpanm = cpanm_bin_installed(home='.')
     if 'cpanm_bin' not in env:
@@ -84,14 +106,112 @@ def installed(module, source=None, locallib='perl5', home='.'):
         export LOCALLIB="perl5"
         export PERL5ARCH=`perl -MConfig -e 'print $Config{archname}'`
         export PERL5LIB="$HOME/$LOCALLIB/lib/perl5:$HOME/$LOCALLIB/lib/perl5/$PERL5ARCH:$HOME/$LOCALLIB/lib/perl5/$PERL5ARCH/auto/"
+
+    Returns ``'changed'`` or ``'unchanged'``.
+    """
+    perlarch = perl_config_archname()
+    try:
+        cpanm = env.cpanm_bin[env.host]
+    except:
+        _prepare_environment()
+        cpanm = env.cpanm_bin[env.host]
+    if _exists(module, home=home, perlarch=perlarch, locallib=locallib):
+        return 'unchanged'
+    _do_install(module, home=home, cpanm=cpanm, source=source, locallib=locallib)
+    return 'changed'
+
+
+
+@completed_ok(arg_output=[0])
+def installed_many(modules, sources=None, locallib='perl5', home='.', jobs=4, bundle=False, local_tmpdir='/tmp'):
+    """
+    Ensure that all the Perl CPAN Modules in the list ``modules`` are installed (in a localized locallib path)
+
+    :param modules: *required* list; the names of the CPAN modules to check/install
+    :param sources: dict; module name -> url to its CPAN dist tarball, for modules not to be installed by name
+    :param locallib: str; the directory name for locallib
+    :param home: str; the base directory where locallib
+    :param jobs: int; number of parallel make/test jobs of the install
+    :param bundle: boolean; if True, install from a bundle built once per perl archname, see below
+    :param local_tmpdir: str; local temp dir path where the bundles are cached
+
+    Same as :func:`installed`, but all the ``modules`` are probed in a single perl process
+    (see :func:`probe_modules`), and the missing ones are installed together in a single
+    cpanm invocation, with ``jobs`` parallel build (``MAKEFLAGS``) and test (``HARNESS_OPTIONS``) jobs.
+
+    With ``bundle``, modules are not built on every host. The first host missing some of them 
+    builds all the ``modules`` (and their non-core dependencies) into a staging locallib, which 
+    is downloaded as a tarball into ``local_tmpdir``, keyed by a hash of the perl archname, the
+    perl version and the module set. Other hosts with the same hash get the tarball uploaded and
+    extracted into their locallib, then the hash is kept in ``locallib/.bundle-hash``, so hosts 
+    that already have it are skipped without probing.
+
+    Returns the list of modules that were installed (empty if nothing changed).
     """
+    if isinstance(modules, basestring):
+        modules = modules.split()
+    if not modules:
+        return [ ]
+    if sources is None:
+        sources = { }
+    perlarch = perl_config_archname()
+    locallib_base = os.path.join(home, locallib)
+    if bundle:
+        bundle_hash = bundle_hash_of(modules, sources, perlarch, facts.get('perl_version'))
+        if run('cat %s/.bundle-hash 2>/dev/null; true' % locallib_base).strip() == bundle_hash:
+            return [ ]
+    missing = [ m for m, version in sorted(probe_modules(modules, home=home, perlarch=perlarch, locallib=locallib).items()) if version is None ]
+    if missing:
+        if bundle:
+            _bundle_extracted(bundle_hash, modules, sources, locallib_base, home=home, jobs=jobs, local_tmpdir=local_tmpdir)
+        else:
+            _cpanm_installed(missing, sources, '-l %s' % locallib_base, jobs=jobs)
+        still_missing = [ m for m, version in sorted(probe_modules(missing, home=home, perlarch=perlarch, locallib=locallib).items()) if version is None ]
+        if still_missing:
+            abort("cpanm failed to install: %s" % ', '.join(still_missing))
+    elif bundle:
+        # installed otherwise (e.g. by name before bundling): skip the probe next time
+        run('mkdir -p %s && echo %s > %s/.bundle-hash' % (locallib_base, bundle_hash, locallib_base))
+    return missing
+
+
+def _cpanm_installed(modules, sources, opts, jobs=4):
     try:
-        perlarch = env.perl_arch[env.host]
         cpanm = env.cpanm_bin[env.host]
     except:
         _prepare_environment()
-        perlarch = env.perl_arch[env.host]
         cpanm = env.cpanm_bin[env.host]
-    if not _exists(module, home=home, perlarch=perlarch, locallib=locallib):
-        _do_install(module, home=home, cpanm=cpanm, source=source, locallib=locallib)
+    with prefix('export AUTOMATED_TESTING=1 PERL_MM_NONINTERACTIVE=1 MAKEFLAGS=-j%d HARNESS_OPTIONS=j%d' % (jobs, jobs)):
+        run('%s %s %s' % (cpanm, opts, ' '.join([ pipes.quote(sources.get(m, m)) for m in modules ])))
+
+
+def bundle_hash_of(modules, sources, perlarch, perl_version):
+    """
+    returns the hash identifying the bundle of ``modules`` (and their ``sources``) for a perl archname + version
+    """
+    key = json.dumps([ perlarch, perl_version, sorted(modules), sorted([ sources.get(m, m) for m in modules ]) ])
+    return hashlib.sha1(key).hexdigest()
+
 
+def _bundle_extracted(bundle_hash, modules, sources, locallib_base, home='.', jobs=4, local_tmpdir='/tmp'):
+    """
+    extracts the bundle into ``locallib_base``, building it on this host if it is not in the local cache yet
+    """
+    bundle_local = os.path.join(local_tmpdir, getpass.getuser(), 'deploy', 'cpan-bundles', '%s.tgz' % bundle_hash)
+    bundles_remote = os.path.join(home, '.deploy', 'cpan-bundles')
+    bundle_remote = os.path.join(bundles_remote, '%s.tgz' % bundle_hash)
+    run('mkdir -p %s' % bundles_remote)
+    # concurrent hosts (e.g. executor workers) wait for the first one to build the bundle
+    with local_lock(bundle_local + '.lock'):
+        if not os.path.exists(bundle_local):
+            staging_remote = os.path.join(bundles_remote, bundle_hash)
+            run('rm -rf %s' % staging_remote)
+            _cpanm_installed(sorted(modules), sources, '-L %s' % staging_remote, jobs=jobs)
+            run('tar -C %s -czf %s . && rm -rf %s' % (staging_remote, bundle_remote, staging_remote))
+            get(bundle_remote, bundle_local + '.part')
+            os.rename(bundle_local + '.part', bundle_local)
+            puts("Built bundle %s for %s" % (bundle_hash, env.host_string))
+        else:
+            put(bundle_local, bundle_remote)
+    run('mkdir -p %(locallib)s && tar -C %(locallib)s -xzf %(bundle)s && rm -f %(bundle)s && echo %(hash)s > %(locallib)s/.bundle-hash' % {
+        'locallib': locallib_base, 'bundle': bundle_remote, 'hash': bundle_hash })
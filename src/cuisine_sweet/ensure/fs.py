@@ -20,8 +20,11 @@ def dir_created(path, recursive=False, mode=None, owner=None, group=None):
     :param owner: str; user/uid that should own the file, as passed to chown
     :param group: str; user/uid that should own the file, as passed to chgrp
 
+    Returns ``'changed'`` or ``'unchanged'``.
     """
+    before = _stat(path)
     cuisine.dir_ensure(path, recursive=recursive, mode=mode, owner=owner, group=group)
+    return 'changed' if _stat(path) != before else 'unchanged'
 
 
 @completed_ok(arg_output=[0,1])
@@ -31,6 +34,17 @@ def dir_symlink_created(src, dest, symbolic=True, mode=None, owner=None, group=N
 
     :param src: *required* str; path to the source real directory
     :param dest: *required* str; path to the destination symlink
+
+    Returns ``'changed'`` or ``'unchanged'``.
     """
+    before = _stat(dest)
     cuisine.file_link(src, dest, symbolic=symbolic, mode=mode, owner=owner, group=group)
     cuisine.file_is_link(src)
+    return 'changed' if _stat(dest) != before else 'unchanged'
+
+
+def _stat(path):
+    """
+    returns the type, mode, owner, group and (link) name of ``path``, or '' if it does not exist
+    """
+    return run('stat -c "%%F %%a %%U %%G %%N" %s 2>/dev/null; true' % path)
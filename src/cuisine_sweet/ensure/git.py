@@ -3,20 +3,22 @@ Fabfile functions for ensuring the state of deployed code from git
 """
 
 import os
+import re
+import pipes
 import sys
+import time
 import cuisine
 
-from fabric.api import env, cd, lcd, local, run, put, abort
-from fabric.utils import error
-from fabric.auth import get_password
+from fabric.api import env, cd, lcd, local, run, put, abort, settings, puts
+from fabric.utils import warn
 from fabric.network import normalize
-from fabric.version import get_version
 from cuisine_sweet import git
-from cuisine_sweet.utils import completed_ok, local_run_expect
+from cuisine_sweet import ssh
+from cuisine_sweet.utils import completed_ok, run_once, local_run_expect, local_run_expect_many, ensure_metric
 
 
 @completed_ok(arg_output=[0,1])
-def rsync(repo_url, repo_dir, refspec='master', home='.', base_dir='git', local_tmpdir='/tmp', save_history=False, do_delete=True, check_hostkey=True):
+def rsync(repo_url, repo_dir, refspec='master', home='.', base_dir='git', local_tmpdir='/tmp', save_history=False, do_delete=True, check_hostkey=True, force=False, fanout=0, seeds=1, releases=0, local_clones_max_mb=2048, transfer='rsync', submodule_jobs=4):
     """
     Does a git clone locally first then rsync to remote.
 
@@ -26,9 +28,16 @@ def rsync(repo_url, repo_dir, refspec='master', home='.', base_dir='git', local_
     :param home: str; home directory to deploy the code to.
     :param base_dir: str; dir name relative to ``home``. 
     :param local_tmpdir: str; where the local clone + checkout will be located
-    :param save_history: bool; if True, then the history of every deploys is tracked, for rollback purposes later.
+    :param save_history: bool; if True, then every deploy is appended to the remote history (``home/.deploy/git/history``), for rollback purposes later.
     :param do_delete: bool; if True, then rsync parameter --delete-during will be added
     :param check_hostkey: bool; if True, then ssh option StrictHostKeyChecking is enabled
+    :param force: bool; if True, then rsync even if the remote deploy marker is up-to-date
+    :param fanout: int; if > 0, enables peer-seeded distribution, see below
+    :param seeds: int; number of hosts that are rsync-ed from the local clone when ``fanout`` > 0
+    :param releases: int; if > 0, deploy into release dirs and keep this many releases, see below
+    :param local_clones_max_mb: int; size cap of all the local clones in ``local_tmpdir``, least recently used ones are removed beyond it
+    :param transfer: str; ``'rsync'`` (default) or ``'delta'``, see below
+    :param submodule_jobs: int; number of submodules cloned/fetched in parallel
     
     Problem statement: How do we ensure that code from a git repository gets deployed 
     uniformly, efficiently across all remote hosts.
@@ -46,16 +55,62 @@ def rsync(repo_url, repo_dir, refspec='master', home='.', base_dir='git', local_
     ensured to be fresh (``git clone + git fetch``). This means only commits fetched from the
     ``repo_url`` can be deployed. 
 
+    The ``repo_url`` is fetched into a single local bare mirror, at most once per fab run
+    (see :func:`cuisine_sweet.git.local_mirror_fetched`). The per-host checkouts are cloned
+    from this mirror with ``--shared``, so they are cheap to create and to fetch. Submodules are
+    updated from local mirrors too (see :func:`cuisine_sweet.git.local_submodules_updated`). Only ``repo_dir``
+    is rsync-ed; local clones of other repos are kept until they are evicted (least recently 
+    used first) to keep all the local clones under ``local_clones_max_mb``.
+
+    After a successful rsync, a deploy marker (commit hash + tree fingerprint) is saved in the
+    remote ``home/.deploy/git/markers`` dir. When the marker already matches the resolved 
+    ``refspec``, the rsync is skipped entirely. Returns ``'changed'`` or ``'unchanged'``.
+
+    The rsync goes through a shared ssh master connection to the host (see :mod:`cuisine_sweet.ssh`),
+    so repeated deploys (and ``env.gateway`` hops) skip the ssh handshake and password prompt.
+
+    Instead of listing every file, rsync shows a single live progress line (rsync >= 3.1).
+    Its ``--stats`` are then summarized and added to the ensure metrics 
+    (see :func:`cuisine_sweet.utils.completed_ok`).
+
+    For large fleets, ``fanout`` relieves the uplink of the deploy box: only the first ``seeds``
+    hosts of ``env.hosts`` are rsync-ed from the local clone. Every other host pulls the repo
+    from an already deployed peer (an earlier host in ``env.hosts``), forming a tree where each 
+    peer serves at most ``fanout`` hosts. The peer rsync runs on the remote host, so it must be 
+    able to ssh into its peer (the ssh agent is forwarded). Hosts can be deployed concurrently 
+    (``@parallel`` or :func:`cuisine_sweet.executor.execute`), in waves down the tree: a host first
+    waits for the deploy marker of its peer to reach the same commit, for up to 
+    ``env.fanout_peer_wait`` seconds (default 300), and is rsync-ed from the local clone otherwise.
+    In this mode, the deployed tree of every host is verified against the digest of the local 
+    clone, and the rsync always deletes extraneous files.
+
+    With ``releases``, each deploy is rsync-ed into a new release dir under 
+    ``home/base_dir/.releases/repo_dir``, hard-linked against the previous release (``--link-dest``)
+    so only changed files are transferred. ``home/base_dir/repo_dir`` then becomes the ``current``
+    symlink to the new release, flipped atomically, and only the latest ``releases`` dirs are kept.
+    An existing non-release ``repo_dir`` is hard-link copied as the first release (even when its
+    deploy marker is already at ``refspec``). To roll back
+    to a kept release, see :func:`release_activated`.
+
+    With ``transfer='delta'``, the remote tree is not scanned at all: the commit of the deploy 
+    marker is the manifest of what is deployed, so the changed and deleted paths are computed 
+    locally with ``git diff`` from that commit (recursing into submodules). The deletions are 
+    applied (unless ``do_delete`` is False), then the changed files are sent as one compressed tar over the ssh master connection,
+    so the cost scales with the size of the change, not of the tree. With ``releases``, the new 
+    release is a hard-link copy of the current one, patched in place (files are unlinked before
+    being written). Files changed on the remote host outside of deploys are not detected; 
+    it falls back to a full rsync when there is no marker, when the marker commit is not in the 
+    local clone, when a submodule is added, for ``fanout`` peers, and with ``force``.
+
     """
     # ensure git + rsync is available locally
-    local('which git')
-    local('which rsync')
+    _local_commands_found('git', 'rsync')
 
     # resolve user,host,port for rsh string
     user, host, port = normalize(env.host_string)
 
     # ensure the temp paths are ready 
-    local_user = local('whoami', capture=True)
+    local_user = git.local_whoami()
     clone_basepath_local = os.path.join(local_tmpdir, local_user, 'deploy', host, user, str(port), 'git')
     local('mkdir -p %s' % clone_basepath_local)
 
@@ -63,79 +118,305 @@ def rsync(repo_url, repo_dir, refspec='master', home='.', base_dir='git', local_
     clone_basepath_remote = os.path.join(home, base_dir)
     cuisine.dir_ensure(clone_basepath_remote)
 
-    # prepare history (for recovery)
-    hist = git.GitHistory()
-    if save_history:
-        remote_hist_path = git.get_remote_git_history_path(home)
-        try:
-            tmphist = git.load_remote_git_history(remote_hist_path, local_user=local_user)
-            if tmphist is not None:
-                hist = tmphist
-        except Exception, e:
-            error("Warning: Unable to load history file %s: %s" % (remote_hist_path, e ))
-            
-    # needed later for us to delete the unneeded repo clones
-    local_clones_dirs = local('cd %s && ls' % clone_basepath_local, capture=True).split("\n")
-    local_clones = { }
-    for lc in local_clones_dirs:
-        local_clones[lc] = True
-
     # clone, reset, log to history
     clone_path_remote = os.path.join(clone_basepath_remote, repo_dir)
     clone_path_local = os.path.join(clone_basepath_local, repo_dir)
 
+    mirror_path = git.local_mirror_fetched(repo_url, local_tmpdir=local_tmpdir, local_user=local_user)
     cloned_locally = local('test -d "%s" && echo OK; true' % clone_path_local, capture=True).endswith('OK')
     if not cloned_locally:
         with lcd(clone_basepath_local):
-            local('git clone %s %s' % (repo_url, repo_dir))
+            local('git clone -q --shared %s %s' % (mirror_path, repo_dir))
+    # mark as used in this run early, so that concurrent hosts do not evict it
+    os.utime(clone_path_local, None)
 
     with lcd(clone_path_local):
-        local('git fetch')
+        # origin stays at repo_url so that relative submodule urls still resolve
+        local('git remote set-url origin %s' % repo_url)
+        local('git fetch -q %s "+refs/heads/*:refs/remotes/origin/*" "+refs/tags/*:refs/tags/*"' % mirror_path)
         local('git reset --hard "origin/%s"' % refspec)
-        local('git submodule update --init --recursive')
-        fuller_log = local('git log -n1 --pretty=fuller', capture=True)
-        hist.log_latest(repo_url, refspec, repo_dir, fuller_log)
+        commit_hash = local('git rev-parse HEAD', capture=True).strip()
+    git.local_submodules_updated(clone_path_local, repo_url, jobs=submodule_jobs, local_tmpdir=local_tmpdir, local_user=local_user)
+    fingerprint = git.local_tree_fingerprint(clone_path_local)
+
+    # keep the other local clones, as long as they fit in local_clones_max_mb
+    git.local_clones_evicted(local_tmpdir, local_user=local_user, max_mb=local_clones_max_mb, used=clone_path_local)
+
+    remote_marker_path = git.get_remote_deploy_marker_path(home, base_dir, repo_dir)
+    deployed_marker = git.load_remote_deploy_marker(remote_marker_path)
+    if not force and deployed_marker == (commit_hash, fingerprint):
+        # a plain deploy switched to releases still needs its first release + symlink
+        if releases == 0 or run('test -L %s && echo OK; true' % clone_path_remote).endswith('OK'):
+            return 'unchanged'
+    git.remove_remote_deploy_marker(remote_marker_path)
+
+    rsync_params = [ ]
+    if do_delete or fanout > 0:
+        rsync_params.append('--delete-during')
+
+    # where to rsync from/to
+    rsync_src_local = clone_path_local + "/"
+    deployed_path_remote = clone_path_remote
+    rsync_dest_remote = clone_path_remote
+    if releases > 0:
+        release_id = '%s-%s' % (time.strftime('%Y%m%d%H%M%S', time.gmtime()), commit_hash)
+        previous_release_id = _release_prepared(clone_basepath_remote, repo_dir)
+        if previous_release_id:
+            rsync_params.append('--link-dest=../%s' % previous_release_id)
+        deployed_path_remote = os.path.join(clone_basepath_remote, '.releases', repo_dir, release_id)
+        rsync_dest_remote = deployed_path_remote
+
+    peer = None
+    if fanout > 0:
+        peer = _fanout_peer(fanout, seeds)
+        if peer and not _peer_deployed(peer, remote_marker_path, (commit_hash, fingerprint)):
+            puts("Peer %s is not at %s, rsync-ing from the local clone instead" % (peer, commit_hash))
+            peer = None
+
+    changes = None
+    if transfer == 'delta' and deployed_marker and not force and not peer:
+        changes = git.local_tree_changes(clone_path_local, deployed_marker[0])
+        if changes is not None and not do_delete:
+            changes = (changes[0], [ ])
+        if changes is not None and releases > 0:
+            if previous_release_id:
+                run('cp -al %s %s' % (os.path.join(clone_basepath_remote, '.releases', repo_dir, previous_release_id), deployed_path_remote))
+            else:
+                changes = None
+        if changes is None:
+            puts("No usable delta since %s, falling back to rsync" % deployed_marker[0])
+
+    rsync_started = time.time()
+    if changes is not None:
+        _delta_pushed(clone_path_local, deployed_path_remote, changes, user, host, port, check_hostkey, local_tmpdir)
+    elif peer:
+        rsync_output = _rsync_from_peer(peer, clone_path_remote, deployed_path_remote, " ".join(rsync_params), check_hostkey)
+    else:
+        # rsync over the shared ssh master connection
+        rsh_string = "--rsh=%s" % pipes.quote('ssh %s' % ssh.master_started(user, host, port, check_hostkey=check_hostkey, local_tmpdir=local_tmpdir))
+        prompts, answers = ssh.password_prompts(user, host, port)
+        user_at_host = "%s@%s" % (user, host)
+        rsync_params.extend(_rsync_progress_params())
+        rsync_cmd = '/bin/bash -l -c %s' % pipes.quote('rsync %s --exclude ".git/" -lpthrz %s %s %s:%s' % (" ".join(rsync_params), rsh_string, rsync_src_local, user_at_host, rsync_dest_remote))
+        rsync_output = local_run_expect(rsync_cmd, prompts, answers, logfile=sys.stdout)
+    if changes is None:
+        _rsync_stats_reported(rsync_output, time.time() - rsync_started, peer)
+
+    if fanout > 0:
+        expected_digest = git.local_tree_digest(clone_path_local)
+        if git.remote_tree_digest(deployed_path_remote) != expected_digest:
+            abort("Deployed tree %s does not match commit %s" % (deployed_path_remote, commit_hash))
+
+    if releases > 0:
+        git.save_remote_deploy_marker(deployed_path_remote + '.marker', commit_hash, fingerprint)
+        _release_switched(clone_basepath_remote, repo_dir, release_id, keep=releases)
+
+    git.save_remote_deploy_marker(remote_marker_path, commit_hash, fingerprint)
 
-    if repo_dir in local_clones:
-        del local_clones[repo_dir]
+    if save_history:
+        try:
+            # history (for recovery), including all the commits shipped since the previous deploy
+            hist = git.GitHistory()
+            shipped_log = git.local_git_log(clone_path_local, since=deployed_marker[0] if deployed_marker else None)
+            hist_entry = hist.log_latest(repo_url, refspec, repo_dir, shipped_log)
+            git.migrate_legacy_git_history(home)
+            git.append_remote_git_history(git.get_remote_git_history_path(home, repo_dir), hist, hist_entry, tmpdir=local_tmpdir)
+        except (Exception, SystemExit), e:
+            warn("Unable to save history of %s: %s" % (repo_dir, e ))
+    return 'changed'
 
-    # delete all undocumented local clones
-    for lc in local_clones.keys():
-        with lcd(clone_basepath_local):
-            local('rm -rf %s' % lc)
 
-    if save_history:
-        cuisine.file_write(remote_hist_path, hist.dump())
+@completed_ok(arg_output=[0,1])
+def release_activated(repo_dir, commit_hash, home='.', base_dir='git'):
+    """
+    Ensure that the current release of ``repo_dir`` is the one deployed from ``commit_hash``.
 
-    if( get_version() >= '1.6.2' ):
-        # signature changed in this version
-        passwrd = get_password( user, host, port )
-    else:
-        passwrd = get_password()
+    :param repo_dir: *required* str; dir name of the repo clone
+    :param commit_hash: *required* str; the (possibly abbreviated) git commit hash of the release
+    :param home: str; home directory where the code was deployed to.
+    :param base_dir: str; dir name relative to ``home``. 
 
-    prompts = [ 'Are you sure you want to continue connecting', ".* password:" ]
-    answers = [ 'yes', passwrd ]
+    This is the rollback counterpart of ``rsync(..., releases=N)``: the ``current`` symlink 
+    is switched to the latest kept release of ``commit_hash`` (e.g. as shown by 
+    :func:`cuisine_sweet.git.history_show_commits`), without transferring anything.
+    Returns ``'changed'`` or ``'unchanged'``.
+    """
+    clone_basepath_remote = os.path.join(home, base_dir)
+    releases_path_remote = os.path.join(clone_basepath_remote, '.releases', repo_dir)
+    # stderr is merged into the output by fabric: keep it out of the parsed lines
+    found = run('''cd %s 2>/dev/null && basename "$(readlink %s 2>/dev/null)" && ls -1d *-%s* 2>/dev/null | grep -v '\.marker$' | sort | tail -n1; true''' % (
+        releases_path_remote, os.path.join('..', '..', repo_dir), commit_hash)).splitlines()
+    if len(found) < 2 or not found[1].strip():
+        abort("No release found for %s at %s" % (commit_hash, releases_path_remote))
+    current_release_id, release_id = found[0].strip(), found[1].strip()
+    if current_release_id == release_id:
+        return 'unchanged'
+    if not run('test -d %s && echo OK; true' % os.path.join(releases_path_remote, release_id)).endswith('OK'):
+        abort("Release %s of %s is not a directory" % (release_id, releases_path_remote))
+
+    release_marker = git.load_remote_deploy_marker(os.path.join(releases_path_remote, release_id + '.marker'))
+    remote_marker_path = git.get_remote_deploy_marker_path(home, base_dir, repo_dir)
+    git.remove_remote_deploy_marker(remote_marker_path)
+    _release_switched(clone_basepath_remote, repo_dir, release_id)
+    if release_marker:
+        git.save_remote_deploy_marker(remote_marker_path, *release_marker)
+    return 'changed'
+
+
+def _release_prepared(clone_basepath_remote, repo_dir):
+    """
+    returns the id of the current release (to be used for ``--link-dest``), or None
+    """
+    legacy_release_id = '%s-legacy' % time.strftime('%Y%m%d%H%M%S', time.gmtime())
+    releases_path_remote = os.path.join(clone_basepath_remote, '.releases', repo_dir)
+    current_path_remote = os.path.join(clone_basepath_remote, repo_dir)
+    previous_release_id = run('''mkdir -p %(releases)s; if [ -L %(current)s ]; then basename "$(readlink %(current)s)"; elif [ -d %(current)s ]; then cp -al %(current)s %(releases)s/%(legacy)s && echo %(legacy)s; fi''' % {
+        'releases': releases_path_remote, 'current': current_path_remote, 'legacy': legacy_release_id }).strip()
+    return previous_release_id or None
 
-    port_string      = "-p %s" % port
-    hostcheck_string = "-o StrictHostKeyChecking=%s" % ('yes' if check_hostkey else 'no') 
-    gateway_string   = "" if not env.gateway else "%s ssh" % env.gateway
-    rsh_parts        = [ port_string, hostcheck_string, gateway_string ]
-    rsh_string       = "--rsh='ssh %s'" % " ".join(rsh_parts)
 
-    user_at_host = "%s@%s" % (user, host)
+def _release_switched(clone_basepath_remote, repo_dir, release_id, keep=0):
+    """
+    atomically points the ``repo_dir`` symlink to ``release_id``, then removes all but the latest ``keep`` releases
+    """
+    with cd(clone_basepath_remote):
+        target = os.path.join('.releases', repo_dir, release_id)
+        run('ln -sfn %s %s.tmp-link && if [ -d %s ] && [ ! -L %s ]; then mv %s %s.pre-releases; fi && mv -T %s.tmp-link %s && rm -rf %s.pre-releases' % (
+            target, repo_dir, repo_dir, repo_dir, repo_dir, repo_dir, repo_dir, repo_dir, repo_dir))
+        if keep > 0:
+            with cd(os.path.join('.releases', repo_dir)):
+                run('''ls -1d *-* | grep -v '\.marker$' | sort | head -n -%d | grep -vx %s | while read r; do rm -rf "$r" "$r.marker"; done; true''' % (keep, release_id))
 
-    do_delete_param = ''
-    if do_delete:
-        do_delete_param = '--delete-during'
 
-    rsync_cmd = '''/bin/bash -l -c "rsync %s --exclude \".git/" -lpthrvz %s %s %s:%s"''' % (do_delete_param, rsh_string, clone_basepath_local + "/", user_at_host, clone_basepath_remote)
-    local_run_expect(rsync_cmd, prompts, answers, logfile=sys.stdout)
 
-    
+def _fanout_peer(fanout, seeds):
+    """
+    returns the host string of the peer to rsync from, or None if this host is a seed
+    """
+    hosts = [ normalize(h) for h in (env.all_hosts or env.hosts) ]
+    this_host = normalize(env.host_string)
+    if this_host not in hosts:
+        return None
+    i = hosts.index(this_host)
+    if i < seeds:
+        return None
+    peer_user, peer_host, peer_port = hosts[(i - seeds) // fanout]
+    return "%s@%s:%s" % (peer_user, peer_host, peer_port)
+
+
+def _peer_deployed(peer, remote_marker_path, marker):
+    """
+    waits (up to ``env.fanout_peer_wait`` seconds) until the deploy marker of ``peer`` is ``marker``, returns whether it is
+    """
+    deadline = time.time() + env.get('fanout_peer_wait', 300)
+    with settings(host_string=peer):
+        while git.load_remote_deploy_marker(remote_marker_path) != marker:
+            if time.time() >= deadline:
+                return False
+            time.sleep(5)
+    return True
+
+
+def _rsync_from_peer(peer, src_path_remote, dest_path_remote, rsync_params, check_hostkey):
+    peer_user, peer_host, peer_port = normalize(peer)
+    ssh_opts = "-p %s -o StrictHostKeyChecking=%s -o BatchMode=yes" % (peer_port, 'yes' if check_hostkey else 'no')
+    run('mkdir -p %s' % dest_path_remote)
+    with settings(forward_agent=True):
+        return run('''rsync %s --stats --exclude ".git/" -lpthrz --rsh='ssh %s' %s@%s:%s/ %s''' % (
+            rsync_params, ssh_opts, peer_user, peer_host, src_path_remote, dest_path_remote))
+
+
+# number of paths removed per remote rm command by _delta_pushed()
+DELTA_RM_BATCH = 500
+
+def _delta_pushed(clone_path_local, dest_path_remote, changes, user, host, port, check_hostkey, local_tmpdir):
+    """
+    applies the ``(changed, deleted)`` paths of :func:`cuisine_sweet.git.local_tree_changes` to ``dest_path_remote``
+    """
+    started = time.time()
+    changed, deleted = changes
+    run('mkdir -p %s' % dest_path_remote)
+    with cd(dest_path_remote):
+        for i in range(0, len(deleted), DELTA_RM_BATCH):
+            batch = deleted[i:i + DELTA_RM_BATCH]
+            parents = sorted(set([ os.path.dirname(p) for p in batch if os.path.dirname(p) ]))
+            run('rm -rf -- %s && (rmdir -p --ignore-fail-on-non-empty -- %s 2>/dev/null; true)' % (
+                " ".join([ pipes.quote(p) for p in batch ]), " ".join([ pipes.quote(p) for p in parents ]) or '.'))
+
+    tar_bytes = 0
+    if changed:
+        delta_path_local = clone_path_local + '.delta'
+        list_file = open(delta_path_local + '.list', 'wb')
+        list_file.write('\0'.join(changed) + '\0')
+        list_file.close()
+        local('tar -C %s --null -T %s -czf %s.tgz' % (clone_path_local, delta_path_local + '.list', delta_path_local))
+        tar_bytes = os.path.getsize(delta_path_local + '.tgz')
+        ssh_opts = ssh.master_started(user, host, port, check_hostkey=check_hostkey, local_tmpdir=local_tmpdir)
+        prompts, answers = ssh.password_prompts(user, host, port)
+        untar_remote = 'tar -C %s --unlink-first --recursive-unlink -xzpf -' % dest_path_remote
+        local_run_expect('''/bin/bash -c "ssh %s %s@%s %s < %s.tgz"''' % (ssh_opts, user, host, pipes.quote(untar_remote), delta_path_local), prompts, answers, logfile=sys.stdout)
+        local('rm -f %s.list %s.tgz' % (delta_path_local, delta_path_local))
+
+    seconds = time.time() - started
+    ensure_metric('delta', { 'files_transferred': len(changed), 'files_deleted': len(deleted), 'bytes_sent': tar_bytes, 'seconds': round(seconds, 3) })
+    puts("delta: %s files transferred, %s deleted, sent %s bytes, %.1fs" % (len(changed), len(deleted), tar_bytes, seconds))
+
+
+@run_once
+def _local_commands_found(*commands):
+    for command in commands:
+        local('which %s' % command)
+
+
+@run_once
+def _rsync_progress_params():
+    """
+    returns ``--stats``, plus ``--info=progress2`` if the local rsync supports it (>= 3.1)
+    """
+    params = [ '--stats' ]
+    version = re.search(r'version (\d+)\.(\d+)', local('rsync --version', capture=True))
+    if version and (int(version.group(1)), int(version.group(2))) >= (3, 1):
+        params.append('--info=progress2')
+    return params
+
+
+RSYNC_STATS = {
+    'files_scanned': r'Number of files: ([\d,]+)',
+    'files_transferred': r'Number of (?:regular )?files transferred: ([\d,]+)',
+    'total_size': r'Total file size: ([\d,]+)',
+    'bytes_sent': r'Total bytes sent: ([\d,]+)',
+    'bytes_received': r'Total bytes received: ([\d,]+)',
+    'speedup': r'speedup is ([\d,.]+)',
+}
+
+def parse_rsync_stats(output):
+    """
+    returns a dict of the numbers in the ``--stats`` output of rsync (see :data:`RSYNC_STATS`)
+    """
+    stats = { }
+    for name, pattern in RSYNC_STATS.items():
+        m = re.search(pattern, output)
+        if m:
+            value = m.group(1).replace(',', '')
+            stats[name] = float(value) if '.' in value else int(value)
+    return stats
+
+
+def _rsync_stats_reported(output, seconds, peer=None):
+    stats = parse_rsync_stats(output or '')
+    stats['seconds'] = round(seconds, 3)
+    if peer:
+        stats['peer'] = peer
+    ensure_metric('rsync', stats)
+    puts("rsync%s: %s/%s files transferred, sent %s bytes, received %s bytes, speedup %s, %.1fs" % (
+        ' from %s' % peer if peer else '',
+        stats.get('files_transferred', '?'), stats.get('files_scanned', '?'), 
+        stats.get('bytes_sent', '?'), stats.get('bytes_received', '?'), 
+        stats.get('speedup', '?'), seconds))
 
 
 @completed_ok(arg_output=[0,1,2])
-def ssh_push(repo_url, branch, dest_name, dest_base_path='opt', host_string=None):
+def ssh_push(repo_url, branch, dest_name, dest_base_path='opt', host_string=None, hosts=None, ref=None, depth=0, local_tmpdir='/tmp', check_hostkey=True):
     """
     Deploy to remote via git push and post-receive checkout hook
 
@@ -144,6 +425,11 @@ def ssh_push(repo_url, branch, dest_name, dest_base_path='opt', host_string=None
     :param dest_name: *required* str; name of the directory to checkout the code to.
     :param dest_base_path: str; base dir of dest_name, default 'opt' (relative to ``$HOME``)
     :param host_string: str, the host string, will default to ``env.host_string``
+    :param hosts: list; host strings to push to at once, defaults to ``[host_string]``
+    :param ref: str; the ref of ``repo_url`` to deploy, defaults to ``branch``
+    :param depth: int; if > 0, only the latest ``depth`` commits are fetched locally (shallow mirror)
+    :param local_tmpdir: str; local temp dir path where the shared mirror is kept
+    :param check_hostkey: boolean; if False, the ssh host keys are not checked
 
     Problem statement: How do we ensure that code from a git repository gets deployed 
     uniformly, efficiently across all remote hosts.
@@ -156,44 +442,91 @@ def ssh_push(repo_url, branch, dest_name, dest_base_path='opt', host_string=None
 
     Git is required in remote hosts, but only for handling the  post-receive checkout purpose only.
 
-    All git operations are done on a separate per-repo local tmpdir, and not on a checkout where 
-    the fabfile is located. Everytime this function is invoked, the ``repo_url`` is always
-    ensured to be fresh (``git clone + git fetch``). This means only existing commits fetched from the
-    ``repo_url`` can be deployed. 
-
-    """
-    if host_string is None:
-        host_string = env.host_string
-    
-    # create local clone
-    user, host, port = normalize(host_string)
-    tmpprojdir = os.path.join(tempfile.gettempdir(), 'deploy', host, 'port-'+port, user )
-    if not local('ls %s/%s/.git && echo OK; true' % (tmpprojdir, dest_name), capture=True).endswith('OK'):
-        local('mkdir -p %s' % tmpprojdir)
-        local('(cd %s && git clone -q %s %s && cd %s && git checkout branch)' % (tmpprojdir, repo_url, dest_name, dest_name, branch))
-    with lcd('%s/%s' % (tmpprojdir, dest_name)):
-        local('git fetch -q origin')
-        local('git reset -q --hard origin/%s' % branch )
- 
-    user_home = run('pwd')
-    run('mkdir -p %s/%s' % (dest_base_path, dest_name))
-    if not run('test -d .gitpush/%s.git && echo OK; true' % dest_name ).endswith('OK'):
-        ### http://caiustheory.com/automatically-deploying-website-from-remote-git-repository
-        run('mkdir -p .gitpush/%s.git' % dest_name)
-        with cd('.gitpush/%s.git' % dest_name):
-            run('git init --bare -q')
-            run('git --bare update-server-info')
-            run('git config --bool core.bare false')
-            run('git config --path core.worktree %s/%s/%s' % (user_home, dest_base_path, dest_name))
-            run('git config receive.denycurrentbranch ignore')
-            run("""echo '#!/bin/sh' > hooks/post-receive""")
-            run("""echo 'git checkout -f' >> hooks/post-receive""")
-            run('chmod 755 hooks/post-receive')
- 
-    with lcd('%s/%s' % (tmpprojdir, dest_name)):
-        if not local('git remote | grep dest | head -n1', capture=True).endswith('dest'):
-            local('git remote add dest ssh://%s@%s:%s%s/.gitpush/%s.git' % (user, host, port, user_home, dest_name))
-        local('git push dest +master:refs/heads/%s' % branch)
-    
+    All git operations are done on a local bare mirror of ``repo_url`` shared by all hosts 
+    (see :func:`cuisine_sweet.git.local_mirror_fetched`), and not on a checkout where the 
+    fabfile is located. The mirror is fetched at most once per fab run. This means only existing 
+    commits fetched from the ``repo_url`` can be deployed. 
 
+    The hidden bare repos are prepared host by host, then ``ref`` is pushed concurrently to all
+    the ``hosts`` whose ``branch`` is not already at its commit, through their ssh master 
+    connections (see :mod:`cuisine_sweet.ssh`). The push time and bytes of each host are reported 
+    and added to the ensure metrics. Returns ``'changed'`` or ``'unchanged'``.
 
+    """
+    if hosts is None:
+        hosts = [ host_string or env.host_string ]
+    if ref is None:
+        ref = branch
+    _local_commands_found('git')
+
+    mirror_path = git.local_mirror_fetched(repo_url, local_tmpdir=local_tmpdir, depth=depth)
+    with lcd(mirror_path):
+        commit_hash = local('git rev-parse "%s^{commit}"' % ref, capture=True).strip()
+
+    jobs = [ ]
+    for h in hosts:
+        user, host, port = normalize(h)
+        with settings(host_string=h):
+            git_dir_remote, deployed_commit = _push_repo_prepared(dest_name, dest_base_path, branch)
+        if deployed_commit == commit_hash:
+            continue
+        ssh_command = 'ssh %s' % ssh.master_started(user, host, port, check_hostkey=check_hostkey, local_tmpdir=local_tmpdir)
+        push_cmd = "TIMEFORMAT='push took %%R seconds'; time GIT_SSH_COMMAND=%s git --git-dir=%s push --progress ssh://%s@%s:%s%s +%s:refs/heads/%s" % (
+            pipes.quote(ssh_command), mirror_path, user, host, port, git_dir_remote, commit_hash, branch)
+        prompts, answers = ssh.password_prompts(user, host, port)
+        jobs.append((h, '/bin/bash -c %s' % pipes.quote(push_cmd), prompts, answers))
+    if not jobs:
+        return 'unchanged'
+
+    pushed = { }
+    for h, (exitstatus, signalstatus, output) in local_run_expect_many(jobs).items():
+        pushed[h] = parse_push_stats(output)
+        puts("push to %s: sent %s bytes, %ss" % (h, pushed[h].get('bytes_sent', '?'), pushed[h].get('seconds', '?')))
+    ensure_metric('push', pushed)
+    return 'changed'
+
+
+def _push_repo_prepared(dest_name, dest_base_path, branch):
+    """
+    ensures the hidden bare repo (and post-receive checkout hook) of ``dest_name``,
+    returns its absolute path and the commit of its ``branch`` (or None)
+    """
+    git_dir = '.gitpush/%s.git' % dest_name
+    ### http://caiustheory.com/automatically-deploying-website-from-remote-git-repository
+    out = run(' && '.join([
+        'mkdir -p %s/%s' % (dest_base_path, dest_name),
+        'if [ ! -d %(git_dir)s ]; then mkdir -p %(git_dir)s && git init --bare -q %(git_dir)s && '
+            'git --git-dir=%(git_dir)s --bare update-server-info && '
+            'git --git-dir=%(git_dir)s config --bool core.bare false && '
+            'git --git-dir=%(git_dir)s config --path core.worktree "$PWD/%(dest_base_path)s/%(dest_name)s" && '
+            'git --git-dir=%(git_dir)s config receive.denycurrentbranch ignore && '
+            'printf "#!/bin/sh\\ngit checkout -f\\n" > %(git_dir)s/hooks/post-receive && '
+            'chmod 755 %(git_dir)s/hooks/post-receive; fi' % { 'git_dir': git_dir, 'dest_base_path': dest_base_path, 'dest_name': dest_name },
+        # shallow pushes need receive.shallowUpdate, the hook checks out HEAD
+        'git --git-dir=%s config receive.shallowUpdate true' % git_dir,
+        'git --git-dir=%s symbolic-ref HEAD refs/heads/%s' % (git_dir, branch),
+        'cd %s && pwd && (git rev-parse -q --verify refs/heads/%s; true)' % (git_dir, branch),
+        ])).splitlines()
+    git_dir_remote = out[0].strip()
+    deployed_commit = out[1].strip() if len(out) > 1 else None
+    return git_dir_remote, deployed_commit
+
+
+PUSH_STATS = {
+    'bytes_sent': r'Writing objects: [^\r\n]*?, ([\d.]+) (bytes|KiB|MiB|GiB)',
+    'seconds': r'push took ([\d.]+) seconds',
+}
+
+_PUSH_UNITS = { 'bytes': 1, 'KiB': 1024, 'MiB': 1024 ** 2, 'GiB': 1024 ** 3 }
+
+def parse_push_stats(output):
+    """
+    returns a dict of the bytes sent and the seconds taken by a ``git push --progress`` (see :data:`PUSH_STATS`)
+    """
+    stats = { }
+    written = re.findall(PUSH_STATS['bytes_sent'], output)
+    stats['bytes_sent'] = int(float(written[-1][0]) * _PUSH_UNITS[written[-1][1]]) if written else 0
+    m = re.search(PUSH_STATS['seconds'], output)
+    if m:
+        stats['seconds'] = float(m.group(1))
+    return stats
@@ -7,9 +7,10 @@ This is primarly used for fabfiles that are version-controlled in git.
 import cuisine 
 from fabric.api import local, abort, puts, lcd
 from fabric.colors import green, blue, red
-from cuisine_sweet.utils import this_func
+from cuisine_sweet.utils import this_func, run_once
 
 
+@run_once
 def up_to_date(against=None, path='.'):
     """
     Check if the git checkout in ``path`` is up-to-date ``against`` another refspec.
@@ -28,6 +29,9 @@ def up_to_date(against=None, path='.'):
     
     - checkout1 - this is where you develop your fabfile. From here, push commits to some  central_repo
     - checkout2 - this is where you deploy your fabfile from. It is here that you do ``git fetch + git reset + fab ...``
+
+    The check (and its ``git fetch``) is done once per fab process for each ``against`` and ``path``, 
+    not once per host.
     """
     if not against:
         abort(red("Missing arg: against"))
@@ -39,6 +43,7 @@ def up_to_date(against=None, path='.'):
         puts(green("%s(against=%s): OK" % (this_func(), against)))
 
 
+@run_once
 def clean(path='.'):
     """
     Check if the git checkout in ``path`` is free from dirty/uncommitted changes.
@@ -47,6 +52,7 @@ def clean(path='.'):
 
     For production / stable deploys, this will make sure that you are deploying
     a fabfile that is not tampered / accidentally modified / have untested uncommited feature.
+    It is checked once per fab process for each ``path``.
     """
     num_changes_str = local('git status --porcelain | wc -l', capture=True)
     num_changes = int(num_changes_str)
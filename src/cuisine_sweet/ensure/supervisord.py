@@ -4,33 +4,53 @@ Fabfile functions for ensuring the state of a supervisord instance
 See `Supervisord <http://www.supervisord.org>`_ - an open-source process-control system.
 """
 
+import os
 import re
 import time
-import cuisine
-from fabric.api import run, sudo
+import pipes
+import hashlib
+from fabric.api import run, sudo, abort
 from cuisine_sweet.utils import completed_ok
+from cuisine_sweet.ensure import yum
+from cuisine_sweet import facts
+from cuisine_sweet import stash
+from cuisine_sweet.batch import RemoteBatch
 
 
 @completed_ok()
-def installed(version=None):
+def installed(version=None, artifacts=None, home='.'):
     """
     Ensure that the supervisord is installed.
 
     :param version: str; the exact version string to install (e.g. "3.0a12")
+    :param artifacts: list; urls (or ``(url, sha256)`` tuples) of the supervisor dists (and dependencies) to install from
+    :param home: str; the base directory where the ``artifacts`` are uploaded
 
     If supervisord is not present, the package is sudo() installed via ``easy_install``.
+    With ``artifacts``, they are uploaded from the local stash (see :mod:`cuisine_sweet.stash`) to 
+    ``home/.deploy/stash/supervisor`` and installed from there only (``easy_install -H None -f``), 
+    so the host does not need to reach PyPI.
     
-    Currently RHEL/CentOS flavored.
+    Currently RHEL/CentOS flavored. Returns ``'changed'`` or ``'unchanged'``.
     """
-    cuisine.select_package(option='yum') 
-    cuisine.command_ensure('easy_install', package='python-setuptools')
-    if not cuisine.command_check('supervisord'):
-        if version:
-            sudo('easy_install supervisor==%s' % version)
+    changed = False
+    if 'easy_install' not in facts.get('commands'):
+        changed = bool(yum.packages_installed(['python-setuptools']))
+        facts.invalidate('commands')
+    if 'supervisord' not in facts.get('commands'):
+        changed = True
+        requirement = 'supervisor==%s' % version if version else 'supervisor'
+        if artifacts:
+            artifacts_dir = os.path.join(home, '.deploy', 'stash', 'supervisor')
+            for artifact in artifacts:
+                url, sha256 = artifact if isinstance(artifact, tuple) else (artifact, None)
+                stash.uploaded(url, artifacts_dir, sha256=sha256)
+            sudo('easy_install -H None -f %s %s' % (artifacts_dir, requirement))
         else:
-            sudo('easy_install supervisor')
-            
-        
+            sudo('easy_install %s' % requirement)
+        facts.invalidate('commands')
+    return 'changed' if changed else 'unchanged'
+
 
 
 @completed_ok(arg_output=[0])
@@ -44,8 +64,9 @@ def running(configfile, pidfile, basedir=None, envsource=None, sudo=False):
     :param envsource: str; path to the shell-script to load before running supervisord
     :param sudo: bool; run supervisord under sudo(), otherwise via run()
 
-    Instance checking is based whether the process pid read from pidfile 
-    is running.
+    Instance checking is based whether the process pid read from pidfile is a
+    supervisord running with configfile, per the host's ``supervisord`` fact
+    (see :mod:`cuisine_sweet.facts`). Its liveness is then checked with ``kill -0``.
 
     If basedir is specified, it overrides the '-d' parameter passed when
     running the supervisord daemon. If not specified, then the current
@@ -56,52 +77,49 @@ def running(configfile, pidfile, basedir=None, envsource=None, sudo=False):
 
     If sudo is true, then the supervisord daemon is started via sudo(),
     otherwise, uses the default run() user.
+
+    Returns ``'changed'`` (started) or ``'unchanged'``.
     """
+    # current working directory and pidfile in one round trip; the cwd depends on
+    # the caller's cd() context, so it is not a cached fact
+    lines = run('pwd; cat %s 2>/dev/null; true' % pidfile).splitlines()
     if not basedir:
-        basedir = run('pwd') # current working directory
-    pid = run('cat %s; true' % pidfile)
-
-    running = False
-    if re.match(r'^\d+$', pid):
-        # check
-        pid_running = run('ps -p %s && echo OK; true' % pid).endswith('OK')
-        if pid_running:
-            # ensure that we are using the correct config, otherwise kill first
-            running_cmd = run('ps -p %s ho cmd' % pid)
-            running_cfg_match = re.match(r'.*-c\s+(\S+).*', running_cmd)
-            do_kill = True
-            if running_cfg_match:
-                running_cfg = running_cfg_match.group(1)
-                if running_cfg == configfile:
-                    do_kill = False
-                    running = True
-
-            if do_kill:
-                # kill impostor or old process
-                run('kill %s && sleep 1; true' % pid)
-
-    if not running:
-        xcmd = 'supervisord -d %s -c %s -j %s' % (basedir, configfile, pidfile)
-        if envsource:
-            xcmd = 'source %s && %s' % (envsource, xcmd)
-        if sudo:
-            sudo(xcmd)
-        else:
-            run(xcmd)
-        time.sleep(3)
+        basedir = lines[0].strip()
+    pid = lines[1].strip() if len(lines) > 1 else ''
+    supervisords = facts.get('supervisord')
+    if supervisords.get(pid) == configfile and run('kill -0 %s && echo OK; true' % pid).endswith('OK'):
+        return 'unchanged'
+    if pid in supervisords:
+        # kill impostor or old process
+        run('kill %s && sleep 1; true' % pid)
+
+    xcmd = 'supervisord -d %s -c %s -j %s' % (basedir, configfile, pidfile)
+    if envsource:
+        xcmd = 'source %s && %s' % (envsource, xcmd)
+    if sudo:
+        sudo(xcmd)
+    else:
+        run(xcmd)
+    time.sleep(3)
+    facts.invalidate('supervisord')
 
     # --- test pid if running
-    pid = run('cat %s; true' % pidfile)
-    run('kill -0 %s' % pid)
+    run('kill -0 "$(cat %s)"' % pidfile)
+    return 'changed'
 
 
 
 @completed_ok(arg_output=[0])
-def updated_with_latest_config(configfile):
+def updated_with_latest_config(configfile, restart='all', code_paths=None, batch_size=0, batch_wait=0, home='.'):
     """
     Ensure that the latest config of the supervisord is loaded and reflected.
 
     :param configfile: *required* str; path to the configfile
+    :param restart: str; ``'all'`` (default) or ``'changed'``, which process groups to restart after the update
+    :param code_paths: dict; group name -> path (or list of paths) of the code run by that group
+    :param batch_size: int; if > 0, restart this many groups at a time (rolling restart)
+    :param batch_wait: int; seconds to wait between two batches of a rolling restart
+    :param home: str; the base directory where the code fingerprints are kept
 
     If there are any changes in the supervisord config, the supervisord
     process must be able to do the ff:
@@ -111,13 +129,75 @@ def updated_with_latest_config(configfile):
     - restart programs with updated config
 
     All these is automatically handled via Supervisord's ``reread`` and ``update``
-    commands.
+    commands. The groups reported by ``reread`` are then not restarted a second time.
+
+    With ``restart='all'``, every other group is restarted too. With ``restart='changed'``, 
+    only the groups of ``code_paths`` whose code changed are restarted: a fingerprint of 
+    the files (path, size, mtime) of their paths is compared to the one saved in 
+    ``home/.deploy/supervisord`` after the previous restart. The ``code_paths`` may be symlinks
+    (e.g. the ``current`` release symlink of ``ensure.git.rsync(..., releases=N)``), they are followed.
+
+    Returns the sorted list of the groups that were updated or restarted.
 
     Assumption: The ``configfile`` must contain the correct settings for ``[supervisorctl]``
     including the username and password.
     """
-    run('which supervisorctl')
-    run('supervisorctl -c %s reread' % configfile)
-    run('supervisorctl -c %s update' % configfile)
-    run('supervisorctl -c %s restart all' % configfile)
-
+    if code_paths is None:
+        code_paths = { }
+    supervisorctl = 'supervisorctl -c %s' % configfile
+    fingerprints_path = os.path.join(home, '.deploy', 'supervisord', '%s.code' % hashlib.sha1(configfile).hexdigest()[0:12])
+    probes = RemoteBatch()
+    probes.add('reread', '%s reread' % supervisorctl)
+    probes.add('status', '%s status' % supervisorctl)
+    probes.add('fingerprints', 'cat %s' % fingerprints_path)
+    for group, paths in code_paths.items():
+        probes.add('code %s' % group, CODE_FINGERPRINT_CMD % ' '.join(_listed(paths)))
+    results = probes.run()
+    if results['reread'].failed:
+        abort("supervisorctl reread failed: %s" % results['reread'])
+
+    updated = { }
+    for line in results['reread'].splitlines():
+        m = re.match(r'^(\S+): (changed|available|disappeared)$', line.strip())
+        if m:
+            updated[m.group(1)] = m.group(2)
+    if updated:
+        run('%s update' % supervisorctl)
+
+    fingerprints = { }
+    for group in code_paths:
+        fingerprints[group] = results['code %s' % group].strip().split('\n')[-1]
+    saved = { }
+    for line in results['fingerprints'].splitlines():
+        parts = line.split()
+        if len(parts) == 2:
+            saved[parts[0]] = parts[1]
+
+    if restart == 'all':
+        groups = set([ m.group(1) for m in [ re.match(STATUS_LINE, line) for line in results['status'].splitlines() ] if m ])
+    else:
+        groups = set([ group for group in code_paths if fingerprints[group] != saved.get(group) ])
+    groups = sorted(groups - set(updated.keys()))
+    step = batch_size if batch_size > 0 else max(len(groups), 1)
+    for i in range(0, len(groups), step):
+        if i > 0 and batch_wait:
+            time.sleep(batch_wait)
+        run('%s restart %s' % (supervisorctl, ' '.join([ pipes.quote('%s:*' % group) for group in groups[i:i + step] ])))
+
+    if code_paths:
+        run('mkdir -p %s && printf "%%s %%s\\n" %s > %s' % (os.path.dirname(fingerprints_path), 
+            ' '.join([ '%s %s' % (group, fp) for group, fp in sorted(fingerprints.items()) ]), fingerprints_path))
+    return sorted(set(groups) | set(updated.keys()))
+
+
+# a line of ``supervisorctl status``, the group name being group(1)
+STATUS_LINE = r'^([^\s:]+)(:\S+)?\s+(STOPPED|STARTING|RUNNING|BACKOFF|STOPPING|EXITED|FATAL|UNKNOWN)\b'
+
+# fingerprint of the files (path, size, mtime) under the given paths, see updated_with_latest_config()
+CODE_FINGERPRINT_CMD = "find -H %s -path '*/.git' -prune -o -type f -printf '%%p %%s %%T@\\n' 2>/dev/null | LC_ALL=C sort | md5sum | cut -d' ' -f1"
+
+
+def _listed(paths):
+    if isinstance(paths, basestring):
+        return [ paths ]
+    return paths
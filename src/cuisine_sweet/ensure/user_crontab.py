@@ -5,8 +5,9 @@ A user-crontab is a crontab schedule for a specific user, usually
 loaded from a file (for version-control purposes).
 """
 
-from fabric.api import run, sudo
+from fabric.api import run, sudo, abort
 from cuisine_sweet.utils import completed_ok
+from cuisine_sweet import facts
 
 
 @completed_ok(arg_output=[0])
@@ -18,16 +19,17 @@ def loaded(crontab_file):
 
     This ensures that the correct crontab is loaded. 
     Correct means the loaded one should match what is in the file. 
-    Otherwise it gets reloaded from the file.
+    Otherwise it gets reloaded from the file. The loaded crontab is checked via 
+    the host's ``crontab_md5`` fact (see :mod:`cuisine_sweet.facts`).
+    Returns ``'changed'`` (reloaded) or ``'unchanged'``.
     """
-    run('which md5sum')
-    loaded = run('crontab -l >& /dev/null && echo OK; true').endswith('OK')
-    if loaded:
-        loaded_checksum = run('crontab -l | md5sum')
+    if 'md5sum' not in facts.get('commands'):
+        abort("md5sum not found")
+    loaded_checksum = facts.get('crontab_md5')
+    if loaded_checksum is not None:
         expected_checksum = run('cat %s | md5sum' % crontab_file)
-        if loaded_checksum != expected_checksum:
-            # reload
-            run('crontab %s' % crontab_file)
-    else:
-        run('crontab %s' % crontab_file)
-
+        if loaded_checksum == expected_checksum:
+            return 'unchanged'
+    run('crontab %s' % crontab_file)
+    facts.invalidate('crontab_md5')
+    return 'changed'
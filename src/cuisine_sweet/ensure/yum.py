@@ -2,9 +2,12 @@
 Fabfile functions for ensuring the state of yum-based Linux Distro packages
 """
 
+import re
+import pipes
 import cuisine 
-from fabric.api import run, sudo
+from fabric.api import run, sudo, abort
 from cuisine_sweet.utils import completed_ok
+from cuisine_sweet import facts
 
 
 @completed_ok(arg_output=[0])
@@ -19,10 +22,14 @@ def grouppackage_installed(groupname):
 
     For more information on the available yum group packages, 
     issue a ``yum grouplist`` from your RHEL/CentOS flavored OS.
+
+    Returns ``'changed'`` or ``'unchanged'``.
     """
     grp_installed = run('yum grouplist installed "%s" | grep -i installed && echo OK; true' % groupname).endswith('OK')
-    if not grp_installed:
-        sudo('yum -y groupinstall "%s"' % groupname)
+    if grp_installed:
+        return 'unchanged'
+    sudo('yum -y groupinstall "%s"' % groupname)
+    return 'changed'
 
 
 @completed_ok(arg_output=[0])
@@ -32,8 +39,57 @@ def package_installed(package):
 
     :param package: *required* str; the name of the package
 
-    Wraps cuisine.package_ensure() + select_package(option='yum')
+    Wraps cuisine.package_ensure() + select_package(option='yum'), 
+    unless the package is already in the host's ``rpms`` fact.
+    Returns ``'changed'`` or ``'unchanged'``.
     """
+    if package in facts.get('rpms'):
+        return 'unchanged'
     cuisine.select_package(option='yum')
     cuisine.package_ensure(package)
+    facts.invalidate('rpms')
+    return 'changed'
+
+
+
+@completed_ok(arg_output=[0])
+def packages_installed(packages):
+    """
+    Ensure that all the packages in the list `packages` are installed.
+
+    :param packages: *required* list; the names of the packages
 
+    All packages are checked against the host's ``rpms`` fact (see :mod:`cuisine_sweet.facts`);
+    those not found there (e.g. provides, file names or versioned names) are confirmed with a 
+    single remote ``rpm -q --whatprovides`` + ``rpm -q`` query. The missing ones are then 
+    installed together in a single sudo('yum -y install ...') transaction.
+
+    Returns the list of packages that were installed (empty if nothing changed).
+    """
+    if isinstance(packages, basestring):
+        packages = packages.split()
+    if not packages:
+        return [ ]
+    rpms = facts.get('rpms')
+    missing = [ p for p in packages if p not in rpms ]
+    if missing:
+        missing = _rpm_missing(missing)
+    if missing:
+        sudo('yum -y install %s' % ' '.join([ pipes.quote(p) for p in missing ]))
+        facts.invalidate('rpms')
+        still_missing = _rpm_missing(missing)
+        if still_missing:
+            abort("yum failed to install: %s" % ', '.join(still_missing))
+    return missing
+
+
+def _rpm_missing(packages):
+    """
+    returns the ``packages`` that are neither installed by name (or name-version, name.arch)
+    nor provided by an installed package (e.g. ``perl(DBI)``, ``/usr/bin/foo``)
+    """
+    quoted = ' '.join([ pipes.quote(p) for p in packages ])
+    out = run('rpm -q --whatprovides %s; rpm -q %s; true' % (quoted, quoted))
+    not_provided = re.findall(r'^no package provides (\S+)', out, re.M)
+    not_installed = re.findall(r'^package (\S+) is not installed', out, re.M)
+    return [ p for p in packages if p in not_provided and p in not_installed ]
@@ -0,0 +1,148 @@
+"""
+Concurrent multi-host execution of ensure sequences
+
+Fabric's ``@parallel`` forks one process per host and knows nothing about the work 
+that is common to all hosts. Here, the local-side work shared by all hosts (e.g. fetching 
+the local git mirrors, prompting for the password) is done once in the fab process via
+``prepare``. The hosts are then run concurrently in forked workers that inherit it, 
+at most ``pool_size`` at a time. Each worker runs the whole ensure sequence of its host 
+in order.
+
+Usage::
+
+    from fabric.api import task, env
+    from cuisine_sweet import ensure, executor, git
+
+    def deploy_host():
+        ensure.git.rsync('git@ourgit.example.com:myproject.git', 'myproject', refspec='master')
+        ensure.supervisord.updated_with_latest_config('git/myproject/supervisord.conf')
+
+    @task
+    @runs_once
+    def deploy():
+        executor.execute(deploy_host, pool_size=20, 
+            prepare=lambda: git.local_mirror_fetched('git@ourgit.example.com:myproject.git'))
+
+Fabric 1.x keeps the current host in the process-global ``env``, so the workers are 
+processes and not threads.
+"""
+
+import sys
+import time
+import getpass
+import multiprocessing
+import fabric.state
+from fabric.api import env, abort, puts
+from fabric.api import execute as fabric_execute
+from fabric.colors import green, red
+from cuisine_sweet import utils
+
+
+class HostPrefixedStream(object):
+    """
+    Wraps a stream so that every line written is prefixed by ``[host_string]``, 
+    unless fabric already prefixed it.
+    """
+
+    def __init__(self, stream, host_string):
+        self.stream = stream
+        self.prefix = '[%s] ' % host_string
+        self.at_line_start = True
+
+    def write(self, data):
+        for line in data.splitlines(True):
+            if self.at_line_start and not line.startswith(self.prefix):
+                self.stream.write(self.prefix)
+            self.stream.write(line)
+            self.at_line_start = line.endswith("\n")
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def execute(func, *args, **kwargs):
+    """
+    Runs ``func(*args, **kwargs)`` on every host concurrently, returns a dict of host_string -> return value
+
+    :param hosts: list; host strings to run on, defaults to ``env.hosts``
+    :param pool_size: int; max number of hosts running at the same time (default 10)
+    :param prepare: callable; local-side work run once before the hosts, shared by all of them
+    :param prompt_password: bool; if True, prompt once for ``env.password`` (if not yet set), 
+        so that no worker has to prompt
+
+    Aborts after all hosts are done if any of them failed.
+    """
+    hosts = kwargs.pop('hosts', None) or env.hosts
+    pool_size = kwargs.pop('pool_size', 10)
+    prepare = kwargs.pop('prepare', None)
+    prompt_password = kwargs.pop('prompt_password', False)
+
+    if prompt_password and not env.password:
+        env.password = getpass.getpass('Password for %s: ' % ', '.join(hosts))
+    if prepare is not None:
+        prepare()
+
+    queue = multiprocessing.Queue()
+    pending = list(hosts)
+    workers = { }
+    results = { }
+    failed = { }
+    started = time.time()
+    while pending or workers:
+        while pending and len(workers) < pool_size:
+            host_string = pending.pop(0)
+            worker = multiprocessing.Process(target=_run_host, args=(queue, host_string, func, args, kwargs))
+            worker.start()
+            workers[host_string] = worker
+        while _collect(queue, results, failed, timeout=0.2):
+            pass
+        for host_string, worker in workers.items():
+            if not worker.is_alive():
+                worker.join()
+                del workers[host_string]
+                # the result may still be in flight
+                deadline = time.time() + 5
+                while host_string not in results and host_string not in failed and time.time() < deadline:
+                    _collect(queue, results, failed, timeout=0.5)
+                if host_string not in results and host_string not in failed:
+                    failed[host_string] = 'exit code %s' % worker.exitcode
+
+    puts("executor: %d host(s) done in %.1fs, %d failed" % (len(hosts), time.time() - started, len(failed)), show_prefix=False)
+    for host_string in hosts:
+        if host_string in failed:
+            puts(red("  %s: FAILED (%s)" % (host_string, failed[host_string])), show_prefix=False)
+    if failed:
+        abort("%d host(s) failed: %s" % (len(failed), ', '.join(sorted(failed.keys()))))
+    puts(green("executor: OK"), show_prefix=False)
+    return results
+
+
+def _collect(queue, results, failed, timeout):
+    try:
+        host_string, ok, value, metrics = queue.get(timeout=timeout)
+    except Exception:
+        return False
+    # the workers exit without running atexit, so their ensure metrics are reported here
+    utils._ensure_metrics.extend(metrics)
+    if ok:
+        results[host_string] = value
+    else:
+        failed[host_string] = value
+    return True
+
+
+def _run_host(queue, host_string, func, args, kwargs):
+    # the ssh connections of the fab process are not usable in a forked worker
+    fabric.state.connections.clear()
+    sys.stdout = HostPrefixedStream(sys.stdout, host_string)
+    # only send back the metrics of this host, not those inherited from the fab process
+    del utils._ensure_metrics[:]
+    try:
+        r = fabric_execute(func, *args, hosts=[ host_string ], **kwargs)
+        queue.put((host_string, True, r.get(host_string) if isinstance(r, dict) else r, utils._ensure_metrics))
+    except BaseException, e:
+        queue.put((host_string, False, str(e) or e.__class__.__name__, utils._ensure_metrics))
+    sys.stdout.flush()
@@ -0,0 +1,118 @@
+"""
+Per-run cache of remote host facts
+
+Facts (installed rpms, perl archname, available commands, ...) are gathered for 
+all of them at once in a single remote script, the first time any of them is needed
+on a host. They are then memoized for the rest of the fab run. An ensure that changes 
+a fact (e.g. installs a package) invalidates it, and only the invalidated facts are 
+gathered again when next needed.
+
+Usage::
+
+    from cuisine_sweet import facts
+
+    if 'gcc' not in facts.get('rpms'):
+        sudo('yum -y install gcc')
+        facts.invalidate('rpms')
+"""
+
+import re
+from fabric.api import env
+from cuisine_sweet.batch import RemoteBatch
+
+
+# commands whose path is gathered in the 'commands' fact
+COMMANDS = [ 'git', 'rsync', 'tar', 'curl', 'md5sum', 'sha1sum', 'perl', 'crontab', 
+             'rpm', 'yum', 'easy_install', 'supervisord', 'supervisorctl' ]
+
+PROBES = {
+    'rpms': "rpm -qa --qf '%{NAME}\\n%{NAME}.%{ARCH}\\n'",
+    'perl_archname': "perl -MConfig -e 'print $Config{archname}'",
+    'perl_version': "perl -e 'print $]'",
+    'commands': 'for c in %s; do p=$(command -v $c) && echo "$c $p"; done; true' % ' '.join(COMMANDS),
+    'crontab_md5': 'set -o pipefail; crontab -l | md5sum',
+    'supervisord': "ps -e -o pid= -o args= | grep '[s]upervisord'",
+}
+
+
+def _parse_lines(result):
+    if result.failed:
+        return set()
+    return set([ l.strip() for l in result.splitlines() if l.strip() ])
+
+
+def _parse_str(result):
+    if result.failed:
+        return None
+    return str(result)
+
+
+def _parse_commands(result):
+    commands = { }
+    for line in result.splitlines():
+        parts = line.strip().split(' ', 1)
+        if len(parts) == 2:
+            commands[parts[0]] = parts[1]
+    return commands
+
+
+def _parse_supervisord(result):
+    """
+    returns a dict of pid -> configfile (None if unknown) of the running supervisord processes
+    """
+    processes = { }
+    for line in result.splitlines():
+        m = re.match(r'\s*(\d+)\s+(.*)$', line)
+        if m and re.match(r'(\S*python\S*\s+)?\S*supervisord(\s|$)', m.group(2)):
+            cfg = re.match(r'.*-c\s+(\S+).*', m.group(2))
+            processes[m.group(1)] = cfg.group(1) if cfg else None
+    return processes
+
+
+PARSERS = {
+    'rpms': _parse_lines,
+    'perl_archname': _parse_str,
+    'perl_version': _parse_str,
+    'commands': _parse_commands,
+    'crontab_md5': _parse_str,
+    'supervisord': _parse_supervisord,
+}
+
+
+# host_string -> { fact name -> value }
+_facts = { }
+
+
+def get(name):
+    """
+    returns the fact ``name`` of the current host, gathering all missing facts first if needed
+    """
+    host_facts = _facts.setdefault(env.host_string, { })
+    if name not in host_facts:
+        gather()
+    return host_facts[name]
+
+
+def gather(names=None):
+    """
+    gathers the facts ``names`` (default: all those not yet known) of the current host in one round trip
+    """
+    host_facts = _facts.setdefault(env.host_string, { })
+    if names is None:
+        names = [ n for n in PROBES.keys() if n not in host_facts ]
+    probes = RemoteBatch()
+    for name in sorted(names):
+        probes.add(name, PROBES[name])
+    for name, result in probes.run().items():
+        host_facts[name] = PARSERS[name](result)
+
+
+def invalidate(*names):
+    """
+    forgets the facts ``names`` (default: all) of the current host, so they get gathered again when needed
+    """
+    host_facts = _facts.setdefault(env.host_string, { })
+    if not names:
+        names = host_facts.keys()
+    for name in names:
+        host_facts.pop(name, None)
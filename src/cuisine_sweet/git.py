@@ -1,41 +1,75 @@
 import os
 import re
-import email.utils
+import glob
 import datetime
 import time
+import hashlib
+import getpass
+import json
+import pipes
+import base64
 import yaml
 import cuisine
-from fabric.api import env, local, run, get, abort
+from fabric.api import env, local, lcd, run, abort, execute, hide, puts
+from fabric.colors import green, red
+from fabric.decorators import parallel
+from fabric.network import normalize
+from cuisine_sweet.utils import run_once, local_lock
 
 
 class GitHistory(object):
     """
     Encapsulates the history of git deploys
+
+    Each deploy is an entry ``[ timestamp, [ repo_url, refspec, repo_dir ], commit ]``, 
+    and ``commits`` maps a repo_dir to its entries, latest first.
     """
 
-    def __init__(self, initial_dump={ }):
+    def __init__(self, initial_dump=None):
+        if initial_dump is None:
+            initial_dump = { }
         self.commits = initial_dump
 
     def log_latest(self, repo_url, repo_refspec, repo_dir, log):
-        c = self.parse_fuller_log(log)
+        """
+        adds the deploy of the latest commit in ``log`` (a :data:`GIT_LOG_FORMAT` git log), 
+        returns its entry
+
+        All the commits in ``log`` are recorded as shipped by this deploy. If the latest entry
+        is already for the same commit (a redeploy), only its timestamp is updated.
+        """
+        commits = self.parse_log(log)
         if not (repo_dir in self.commits):
             self.commits[repo_dir] = [ ]
-        do_append = True
-        if len(self.commits[repo_dir]) > 0:
-            # try to check first if the last commit is identical to this commit
-            last_c = self.commits[repo_dir][0][2]['commit_hash']
-            if last_c == c['commit_hash']:
-                # ignore dups
-                do_append = False 
-                # but update last deploy timestamp
-                self.commits[repo_dir][0][0] = time.time()
+        if len(self.commits[repo_dir]) > 0 and self.commits[repo_dir][0][2]['commit_hash'] == commits[0]['commit_hash']:
+            # ignore dups, but update last deploy timestamp
+            self.commits[repo_dir][0][0] = time.time()
+            return self.commits[repo_dir][0]
+        c = dict(commits[0])
+        c['shipped'] = [ [ s['commit_hash'], s['title'] ] for s in commits ]
+        entry = [ time.time(), [ repo_url, repo_refspec, repo_dir ], c ]
+        self.commits[repo_dir].insert(0, entry)
+        return entry
 
-        if do_append:    
-            self.commits[repo_dir].insert(0, [ time.time(), [ repo_url, repo_refspec, repo_dir ], c ])
-
-    def dump(self):
-        return yaml.dump(self.commits)
+    def load_entries(self, lines):
+        """
+        adds entries from their json lines dump, oldest first
+        """
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            entry[2]['date'] = datetime.datetime.strptime(entry[2]['date'], HISTORY_DATE_FORMAT)
+            repo_dir = entry[1][2]
+            if not (repo_dir in self.commits):
+                self.commits[repo_dir] = [ ]
+            self.commits[repo_dir].insert(0, entry)
 
+    def dump_entry(self, entry):
+        c = dict(entry[2])
+        c['date'] = c['date'].strftime(HISTORY_DATE_FORMAT)
+        return json.dumps([ entry[0], entry[1], c ], sort_keys=True)
 
     def repo_history(self, repo_dir):
         if repo_dir in self.commits:
@@ -43,74 +77,501 @@ class GitHistory(object):
         return None
 
 
-    def parse_fuller_log(self, log):
-        lines = log.split("\n")
-        chash = lines.pop(0).split(' ')[1]
-        if re.match(r'Merge', lines[0]):
-            lines.pop(0)
-        author = re.match(r'Author:\s+(.*)$', lines.pop(0)).group(1)
-        date_raw = re.match(r'AuthorDate:\s+(.*)$', lines.pop(0)).group(1)
-        date_p = email.utils.parsedate_tz(date_raw)
-        date_args = date_p[0:6] + tuple([date_p[9]])
-        date = datetime.datetime(*date_args)
-        lines.pop(0)
-        lines.pop(0)
-        lines.pop(0)
-        title = lines.pop(0)
-        message_body = [ ]
-        if len(lines) > 0:
-            lines.pop(0)
-            message_body = lines
-        return { 'commit_hash': chash, 
-                 'author': author, 
-                 'date': date, 
-                 'title': title, 
-                 'message_body': message_body,
-                 }
+    def parse_log(self, log):
+        """
+        returns the commits (latest first) of a git log output in :data:`GIT_LOG_FORMAT`
+        """
+        fields = log.split("\0")
+        commits = [ ]
+        for i in range(0, len(fields) - GIT_LOG_NUM_FIELDS + 1, GIT_LOG_NUM_FIELDS):
+            chash, parents, author, timestamp, title, body = fields[i:i + GIT_LOG_NUM_FIELDS]
+            commits.append({ 'commit_hash': chash.strip(), 
+                             'parents': parents.split(), 
+                             'author': author, 
+                             'date': datetime.datetime.utcfromtimestamp(int(timestamp)), 
+                             'title': title, 
+                             'message_body': body.rstrip("\n").split("\n") if body.strip() else [ ],
+                             })
+        return commits
 
 
 
 # ======================
 
-def get_remote_git_history_path(home, filename='history.yml'):
+# machine-readable git log format (use with ``git log -z``): NUL-separated fields, NUL-terminated commits
+GIT_LOG_FORMAT = '%H%x00%P%x00%an <%ae>%x00%at%x00%s%x00%b'
+GIT_LOG_NUM_FIELDS = 6
+
+# max commits recorded as shipped by a single deploy
+SHIPPED_MAX_COMMITS = 200
+
+HISTORY_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# history entries kept per repo_dir; the history file is compacted once it grows to twice this
+HISTORY_MAX_ENTRIES = 1000
+
+@run_once
+def local_whoami():
     """
-    returns the string path to the remote git history file
+    returns the local user name (asked once per fab process)
     """
-    remote_hist_dir = os.path.join(home, '.deploy', 'git')
-    run('mkdir -p %s' % remote_hist_dir)
-    remote_hist_path = os.path.join(remote_hist_dir, 'history.yml')
-    return remote_hist_path
+    return local('whoami', capture=True)
 
 
-def load_remote_git_history(remote_hist_path, local_user=None, tmpdir='/tmp'):
+def local_mirror_path(repo_url, local_tmpdir='/tmp', local_user=None, depth=0):
+    """
+    returns the string path to the local bare mirror of ``repo_url`` (shallow ones are kept apart)
+    """
     if not local_user:
-        local_user = local('whoami', capture=True)
-    hist = None
-    if cuisine.file_exists(remote_hist_path):
-        tmp_history_path = os.path.join(tmpdir, local_user, 'deploy', env.host, env.user, 'git-history')
-        local('mkdir -p %s' % tmp_history_path)
-        # download
-        downloaded = get(remote_hist_path, local_path=tmp_history_path)
-        hist_dump_yml = open(downloaded[0]).read()
-        local('rm %s' % downloaded[0])
-        # try loading the history dump
-        hist_dump = yaml.load(hist_dump_yml)
-        hist = GitHistory(initial_dump=hist_dump)
+        local_user = local_whoami()
+    name = re.sub(r'[^\w.-]+', '_', repo_url).strip('_')
+    digest = hashlib.sha1(repo_url).hexdigest()[0:8]
+    if depth > 0:
+        digest += '-depth%d' % depth
+    return os.path.join(local_tmpdir, local_user, 'deploy', 'mirrors', '%s-%s.git' % (name, digest))
+
+
+def local_mirror_fetched(repo_url, local_tmpdir='/tmp', local_user=None, depth=0):
+    """
+    Ensures that a local bare mirror of ``repo_url`` exists and is fresh, then returns its path.
+
+    There is only one mirror per ``repo_url`` (shared by all hosts), and it is fetched
+    at most once per fab run. Per-host checkouts are cloned with ``--shared`` from it,
+    so they borrow its objects instead of keeping their own copy; ``gc.pruneExpire`` is
+    set to ``never`` on the mirror so that no gc removes objects a clone still uses.
+
+    With ``depth`` > 0, a separate shallow mirror is kept, with only the latest ``depth`` 
+    commits of each branch (enough to push, not to clone ``--shared`` from).
+    """
+    mirror_path = local_mirror_path(repo_url, local_tmpdir=local_tmpdir, local_user=local_user, depth=depth)
+    _mirror_fetched(repo_url, mirror_path, depth)
+    return mirror_path
+
+
+@run_once
+def _mirror_fetched(repo_url, mirror_path, depth):
+    # run_once is per process: the workers of executor.execute() serialize on a lock file,
+    # and skip the fetch if another one already did it during this fab run
+    with local_lock(mirror_path + '.lock'):
+        stamp = mirror_path + '.fetched'
+        if os.path.exists(stamp) and os.path.getmtime(stamp) >= _process_started:
+            return
+        shallow = ' --depth %d' % depth if depth > 0 else ''
+        mirrored = local('test -d "%s" && echo OK; true' % mirror_path, capture=True).endswith('OK')
+        if not mirrored:
+            local('mkdir -p %s' % os.path.dirname(mirror_path))
+            local('git clone -q --mirror%s %s %s' % (shallow + ' --no-single-branch' if shallow else '', repo_url, mirror_path))
+        # the --shared clones borrow the mirror's objects: no (auto) gc may prune them, even once
+        # unreachable from the mirror (e.g. a force-pushed branch still checked out in a clone)
+        with lcd(mirror_path):
+            local('git config gc.pruneExpire never')
+            if mirrored:
+                local('git fetch -q --prune%s origin' % shallow)
+        open(stamp, 'a').close()
+        os.utime(stamp, None)
+
+
+def local_submodules_updated(clone_path_local, repo_url, jobs=4, local_tmpdir='/tmp', local_user=None):
+    """
+    Ensures that the submodules of the local clone of ``repo_url`` are checked out, recursively.
+
+    Each submodule is cloned/fetched from the local mirror of its url (see :func:`local_mirror_fetched`),
+    so the objects of a submodule shared by many repos and hosts are fetched once per fab run, and 
+    hard-linked into the clones. The submodules of each level are updated with ``jobs`` parallel jobs.
+    Relative submodule urls are resolved against ``repo_url``.
+    """
+    if not os.path.exists(os.path.join(clone_path_local, '.gitmodules')):
+        return
+    with lcd(clone_path_local):
+        urls = _gitmodules_config(local('git config -f .gitmodules -z --get-regexp "^submodule\\..*\\.url$"; true', capture=True), 'url')
+        paths = _gitmodules_config(local('git config -f .gitmodules -z --get-regexp "^submodule\\..*\\.path$"; true', capture=True), 'path')
+        local('git submodule --quiet init')
+        mirrored_urls = { }
+        for name, url in urls.items():
+            mirrored_urls[name] = submodule_url_resolved(url, repo_url)
+            mirror_path = local_mirror_fetched(mirrored_urls[name], local_tmpdir=local_tmpdir, local_user=local_user)
+            local('git config "submodule.%s.url" %s' % (name, mirror_path))
+            if name in paths and os.path.exists(os.path.join(clone_path_local, paths[name], '.git')):
+                local('git -C "%s" remote set-url origin %s' % (paths[name], mirror_path))
+        # git >= 2.38 only clones from local paths if allowed
+        local('git -c protocol.file.allow=always submodule --quiet update --init --jobs %d' % jobs)
+    for name, path in paths.items():
+        if name in mirrored_urls:
+            local_submodules_updated(os.path.join(clone_path_local, path), mirrored_urls[name], jobs=jobs, local_tmpdir=local_tmpdir, local_user=local_user)
+
+
+def _gitmodules_config(output, key):
+    """
+    returns the dict of submodule name -> value of ``key``, from a ``git config -z --get-regexp`` output
+    """
+    values = { }
+    for entry in output.split('\0'):
+        if '\n' in entry:
+            config_key, value = entry.split('\n', 1)
+            values[config_key[len('submodule.'):-len('.' + key)]] = value
+    return values
+
+
+def submodule_url_resolved(url, parent_url):
+    """
+    returns the absolute url of a submodule, resolving ``./`` and ``../`` urls against the superproject's ``parent_url``
+    """
+    if not (url.startswith('./') or url.startswith('../')):
+        return url
+    base = parent_url.rstrip('/')
+    parts = url.split('/')
+    while parts and parts[0] in ('.', '..'):
+        if parts.pop(0) == '..':
+            cut = max(base.rfind('/'), base.rfind(':'))
+            base = base[:cut + 1] if base[cut] == ':' else base[:cut]
+    return base + ('' if base.endswith(':') else '/') + '/'.join(parts)
+
+
+def local_git_log(clone_path_local, since=None, until='HEAD', limit=SHIPPED_MAX_COMMITS):
+    """
+    returns the :data:`GIT_LOG_FORMAT` log of the commits in ``since..until`` (or just ``until``)
+
+    All commits are read with a single ``git log``. If ``since`` is unknown, or is not an ancestor
+    of ``until`` (e.g. a rollback), only ``until`` is logged.
+    """
+    log_cmd = "git log -z --format='%s'" % GIT_LOG_FORMAT
+    with lcd(clone_path_local):
+        log = ''
+        if since:
+            log = local('git cat-file -e "%s^{commit}" 2>/dev/null && %s -n %d %s..%s; true' % (since, log_cmd, limit, since, until), capture=True)
+        if not log.strip("\0 \n"):
+            log = local('%s -n1 %s' % (log_cmd, until), capture=True)
+    return log
+
+
+def local_tree_changes(clone_path_local, since, until='HEAD'):
+    """
+    returns the ``(changed, deleted)`` lists of paths between the commits ``since`` and ``until``
+    of the local clone, including the files of the (checked-out) submodules, 
+    or None if it cannot be computed (e.g. ``since`` is unknown, or a submodule was added).
+    """
+    with lcd(clone_path_local):
+        if not local('git cat-file -e "%s^{commit}" 2>/dev/null && echo OK; true' % since, capture=True).endswith('OK'):
+            return None
+        raw = local('git diff --raw -z --no-renames --no-abbrev %s %s' % (since, until), capture=True)
+    changed, deleted = [ ], [ ]
+    fields = raw.split('\0')
+    for meta, path in zip(fields[0::2], fields[1::2]):
+        old_mode, new_mode, old_hash, new_hash, status = meta.lstrip(':').split()
+        if new_mode == '000000':
+            deleted.append(path)
+        elif '160000' not in (old_mode, new_mode):
+            changed.append(path)
+        elif old_mode == new_mode:
+            sub_changes = local_tree_changes(os.path.join(clone_path_local, path), old_hash, new_hash)
+            if sub_changes is None:
+                return None
+            changed.extend([ os.path.join(path, p) for p in sub_changes[0] ])
+            deleted.extend([ os.path.join(path, p) for p in sub_changes[1] ])
+        else:
+            return None
+    return changed, deleted
+
+
+# start of this fab process: local clones used since then are never evicted, see local_clones_evicted()
+_process_started = time.time()
+
+
+def local_clones_evicted(local_tmpdir='/tmp', local_user=None, max_mb=2048, used=None):
+    """
+    Ensures that the per-host local clones (of ``ensure.git.rsync``) take at most ``max_mb`` 
+    in total, removing the least recently used ones first.
+
+    The clone at path ``used`` is marked as just used. Clones used since the start of the fab
+    process are never removed, as other hosts may still be deploying from them concurrently 
+    (e.g. with :func:`cuisine_sweet.executor.execute`), so the cap can be exceeded during a run.
+    """
+    if not local_user:
+        local_user = local_whoami()
+    if used:
+        os.utime(used, None)
+    clones = glob.glob(os.path.join(local_tmpdir, local_user, 'deploy', '*', '*', '*', 'git', '*'))
+    clones = [ c for c in clones if os.path.isdir(os.path.join(c, '.git')) ]
+    if not clones:
+        return
+    sizes = { }
+    for line in local('du -sk %s' % ' '.join(clones), capture=True).splitlines():
+        kb, path = line.split("\t", 1)
+        sizes[path] = int(kb)
+    total_kb = sum(sizes.values())
+    for clone in sorted(clones, key=lambda c: os.path.getmtime(c)):
+        if total_kb <= max_mb * 1024:
+            break
+        if os.path.getmtime(clone) >= _process_started:
+            break
+        local('rm -rf %s' % clone)
+        total_kb -= sizes.get(clone, 0)
+
+
+def get_remote_deploy_marker_path(home, base_dir, repo_dir):
+    """
+    returns the string path to the remote deploy marker of ``base_dir/repo_dir``
+    """
+    remote_marker_dir = os.path.join(home, '.deploy', 'git', 'markers')
+    name = re.sub(r'[^\w.-]+', '_', os.path.normpath(os.path.join(base_dir, repo_dir)))
+    return os.path.join(remote_marker_dir, name)
+
+
+def local_tree_fingerprint(clone_path_local):
+    """
+    returns a fingerprint of the checked-out tree, including the submodule commits
+    """
+    with lcd(clone_path_local):
+        tree_state = local('git rev-parse "HEAD^{tree}" && git submodule status --recursive', capture=True)
+    return hashlib.sha1(tree_state).hexdigest()
+
+
+# digest of the regular files of a deployed tree (excluding .git), same output locally and remotely
+TREE_DIGEST_CMD = "find . -path '*/.git' -prune -o -type f -print0 | LC_ALL=C sort -z | xargs -0 md5sum | md5sum"
+
+
+def local_tree_digest(path):
+    return local('cd %s && %s' % (path, TREE_DIGEST_CMD), capture=True).strip()
+
+
+def remote_tree_digest(path):
+    return run('cd %s && %s' % (path, TREE_DIGEST_CMD)).strip()
+
+
+def save_remote_deploy_marker(remote_marker_path, commit_hash, fingerprint):
+    run('mkdir -p %s && printf "commit %%s\\ntree %%s\\n" %s %s > %s' % (
+        os.path.dirname(remote_marker_path), commit_hash, fingerprint, remote_marker_path))
+
+
+def remove_remote_deploy_marker(remote_marker_path):
+    run('rm -f %s' % remote_marker_path)
+
+
+def load_remote_deploy_marker(remote_marker_path):
+    """
+    returns the (commit_hash, fingerprint) recorded in the remote deploy marker, or None
+    """
+    marker = run('cat %s 2>/dev/null; true' % remote_marker_path)
+    m = re.match(r'commit\s+(\w+)\s+tree\s+(\w+)', marker.strip())
+    if not m:
+        return None
+    return (m.group(1), m.group(2))
+
+
+def get_remote_git_history_path(home, repo_dir):
+    """
+    returns the string path to the remote git history file of ``repo_dir``
+
+    There is one history file per ``repo_dir`` (the legacy single ``history.yml`` is converted
+    by :func:`migrate_legacy_git_history`), so unlike the legacy ``(home, filename='history.yml')``
+    signature, ``repo_dir`` is required.
+    """
+    name = re.sub(r'[^\w.-]+', '_', os.path.normpath(repo_dir))
+    return os.path.join(home, '.deploy', 'git', 'history', '%s.jsonl' % name)
+
+
+def append_remote_git_history(remote_hist_path, hist, entry, max_entries=HISTORY_MAX_ENTRIES, tmpdir='/tmp'):
+    """
+    appends the ``entry`` of ``hist`` to the remote history file, compacting it when needed
+
+    If the last line of the file is for the same commit (a redeploy, see :meth:`GitHistory.log_latest`),
+    it is replaced by ``entry`` instead. If the local history cache was up-to-date before the append, 
+    it is updated as well.
+    """
+    line = hist.dump_entry(entry)
+    stats = [ l.strip() for l in run(history_append_cmd(remote_hist_path, line, max_entries, 
+                                                        replace_commit=entry[2]['commit_hash'])).splitlines() ]
+    replaced = 'REPLACED' in stats
+    stats = [ l for l in stats if l != 'REPLACED' ]
+    cache = _load_history_cache(remote_hist_path, tmpdir)
+    if cache and len(stats) == 2 and stats[0] == cache['stat'] and (cache['lines'] or not replaced):
+        lines = (cache['lines'][:-1] if replaced else cache['lines']) + [ line ]
+        if len(lines) > max_entries * 2:
+            lines = lines[-max_entries:]
+        _save_history_cache(remote_hist_path, tmpdir, stats[1], lines, cache['complete'])
+
+
+def history_append_cmd(remote_hist_path, line, max_entries=HISTORY_MAX_ENTRIES, replace_commit=None):
+    """
+    returns the remote shell command appending ``line`` to the history file (see :func:`append_remote_git_history`),
+    which prints the stat of the file before and after
+
+    If the last line is for the commit ``replace_commit``, it is removed first, and ``REPLACED`` is printed.
+    The line is sent base64-encoded: fabric does not escape backslashes when wrapping 
+    the command, so quoting the json itself is not reliable.
+    """
+    replace = ''
+    if replace_commit:
+        replace = '''if tail -n1 %(path)s 2>/dev/null | grep -qF %(pattern)s; then sed -i '$d' %(path)s && echo REPLACED; fi; ''' % {
+            'path': remote_hist_path, 
+            'pattern': pipes.quote('"commit_hash": "%s"' % replace_commit) }
+    return '''mkdir -p %(dir)s && %(stat)s; %(replace)secho %(b64)s | base64 -d >> %(path)s && if [ "$(wc -l < %(path)s)" -gt %(max)d ]; then tail -n %(keep)d %(path)s > %(path)s.tmp && mv %(path)s.tmp %(path)s; fi && %(stat)s''' % {
+        'dir': os.path.dirname(remote_hist_path), 
+        'stat': _history_stat_cmd(remote_hist_path),
+        'replace': replace,
+        'b64': base64.b64encode(line + "\n"), 
+        'path': remote_hist_path, 
+        'max': max_entries * 2, 
+        'keep': max_entries }
+
+
+def load_remote_git_history(remote_hist_path, local_user=None, tmpdir='/tmp', limit=None):
+    """
+    returns the GitHistory of the latest ``limit`` (or all) entries in the remote history file, or None
+
+    ``local_user`` is ignored (the cache is kept under the local user running fab); it is only
+    kept for compatibility with the legacy positional arguments.
+
+    The entries are cached locally (under ``tmpdir``) per host, user and path. The remote file is 
+    only read if its size, mtime or inode differs from the cached one; either way it takes one 
+    remote command.
+    """
+    cache = _load_history_cache(remote_hist_path, tmpdir)
+    cached_stat = ''
+    if cache and (cache['complete'] or (limit and len(cache['lines']) >= limit)):
+        cached_stat = cache['stat']
+    tail_opt = '-n %d' % limit if limit else '-n +1'
+    dump = run('''if [ ! -f %(path)s ]; then echo NO_HISTORY; elif [ "$(%(stat)s)" = %(cached_stat)s ]; then echo CACHED; else %(stat)s && tail %(tail_opt)s %(path)s; fi''' % {
+        'path': remote_hist_path, 
+        'stat': _history_stat_cmd(remote_hist_path), 
+        'cached_stat': pipes.quote(cached_stat), 
+        'tail_opt': tail_opt }).splitlines()
+    if not dump or dump[0].strip() == 'NO_HISTORY':
+        return None
+    if dump[0].strip() == 'CACHED':
+        lines = cache['lines']
+    else:
+        lines = [ l.strip() for l in dump[1:] if l.strip() ]
+        _save_history_cache(remote_hist_path, tmpdir, dump[0].strip(), lines, not limit or len(lines) < limit)
+    if limit:
+        lines = lines[-limit:]
+    hist = GitHistory()
+    hist.load_entries(lines)
     return hist
 
 
+def _history_stat_cmd(remote_hist_path):
+    return "stat -c '%%s %%Y %%i' %s 2>/dev/null" % remote_hist_path
+
+
+# local history caches loaded so far in this fab run, see load_remote_git_history()
+_history_caches = { }
+
+
+def _history_cache_path(remote_hist_path, tmpdir):
+    user, host, port = normalize(env.host_string)
+    return os.path.join(tmpdir, getpass.getuser(), 'deploy', 'history-cache', host, user, str(port), 
+                        '%s.json' % hashlib.sha1(remote_hist_path).hexdigest())
+
 
-def history_show_commits(repo_dir, limit=10, home='.'):
+def _load_history_cache(remote_hist_path, tmpdir):
+    cache_path = _history_cache_path(remote_hist_path, tmpdir)
+    if cache_path not in _history_caches:
+        cache = None
+        if os.path.exists(cache_path):
+            try:
+                cache = json.load(open(cache_path))
+            except ValueError:
+                pass
+        _history_caches[cache_path] = cache
+    return _history_caches[cache_path]
+
+
+def _save_history_cache(remote_hist_path, tmpdir, stat, lines, complete):
+    cache_path = _history_cache_path(remote_hist_path, tmpdir)
+    cache = { 'stat': stat, 'lines': lines, 'complete': complete }
+    if not os.path.isdir(os.path.dirname(cache_path)):
+        os.makedirs(os.path.dirname(cache_path))
+    f = open(cache_path, 'w')
+    json.dump(cache, f)
+    f.close()
+    _history_caches[cache_path] = cache
+
+
+# (host_string, home) already checked for a legacy history file in this fab run
+_migrated_homes = { }
+
+
+def migrate_legacy_git_history(home='.', max_entries=HISTORY_MAX_ENTRIES):
+    """
+    Converts the legacy single-file ``history.yml`` (if any) into per-repo_dir history files.
+
+    The legacy file is renamed to ``history.yml.migrated`` afterwards.
+    """
+    if (env.host_string, home) in _migrated_homes:
+        return
+    _migrated_homes[(env.host_string, home)] = True
+    legacy_hist_path = os.path.join(home, '.deploy', 'git', 'history.yml')
+    if not cuisine.file_exists(legacy_hist_path):
+        return
+    legacy_hist = GitHistory(initial_dump=yaml.load(cuisine.file_read(legacy_hist_path)))
+    run('mkdir -p %s' % os.path.join(home, '.deploy', 'git', 'history'))
+    for repo_dir, entries in legacy_hist.commits.items():
+        remote_hist_path = get_remote_git_history_path(home, repo_dir)
+        lines = [ legacy_hist.dump_entry(e) for e in reversed(entries[0:max_entries]) ]
+        cuisine.file_write(remote_hist_path, "\n".join(lines) + "\n")
+    run('mv %s %s.migrated' % (legacy_hist_path, legacy_hist_path))
+
+
+def history_show_commits(repo_dir, limit=10, home='.', tmpdir='/tmp'):
     """
     params(repo_dir, limit=10)
     """
-    remote_hist_path = get_remote_git_history_path(home)
-    hist = load_remote_git_history(remote_hist_path)
+    migrate_legacy_git_history(home)
+    remote_hist_path = get_remote_git_history_path(home, repo_dir)
+    hist = load_remote_git_history(remote_hist_path, limit=limit, tmpdir=tmpdir)
     if not hist:
         abort("No history found")
 
     repo_history = hist.repo_history(repo_dir)
     print yaml.dump(repo_history[0:limit])
-    
 
 
+def history_fleet_report(repo_dir, home='.', hosts=None, pool_size=10, tmpdir='/tmp'):
+    """
+    params(repo_dir, home='.', hosts=None, pool_size=10)
+
+    Prints which commit of ``repo_dir`` is deployed on which of the ``hosts`` (default: ``env.hosts``),
+    based on the latest entry of each host's history. The hosts are queried in parallel, at most
+    ``pool_size`` at a time. Hosts not on the most recently deployed commit are flagged as stragglers.
+
+    Returns a dict of commit_hash -> list of host strings (hosts without history are under None).
+
+    It queries all the ``hosts`` itself, so call it from a ``@runs_once`` task (or locally).
+    """
+    if hosts is None:
+        hosts = env.hosts
+    latest = execute(parallel(pool_size=pool_size)(_latest_deploy), repo_dir, home=home, tmpdir=tmpdir, hosts=hosts)
+
+    by_commit = { }
+    deployed = { }
+    for host_string, entry in latest.items():
+        commit_hash = None
+        if entry:
+            commit_hash = entry[2]['commit_hash']
+            if commit_hash not in deployed or entry[0] > deployed[commit_hash][0]:
+                deployed[commit_hash] = entry
+        by_commit.setdefault(commit_hash, [ ]).append(host_string)
+
+    newest = None
+    if deployed:
+        newest = max(deployed.values(), key=lambda e: e[0])[2]['commit_hash']
+    puts("%s: %d commit(s) deployed across %d host(s)" % (repo_dir, len(deployed), len(latest)), show_prefix=False)
+    for commit_hash in sorted(deployed.keys(), key=lambda h: deployed[h][0], reverse=True):
+        c = deployed[commit_hash][2]
+        color = green if commit_hash == newest else red
+        label = '' if commit_hash == newest else ' STRAGGLERS'
+        puts(color("  %s  %s  %-40.40s (%d)%s" % (commit_hash[0:10], c['date'], c['title'].strip(), len(by_commit[commit_hash]), label)), show_prefix=False)
+        puts("      %s" % ", ".join(sorted(by_commit[commit_hash])), show_prefix=False)
+    if None in by_commit:
+        puts(red("  %-10s  no history (%d)" % ('-', len(by_commit[None]))), show_prefix=False)
+        puts("      %s" % ", ".join(sorted(by_commit[None])), show_prefix=False)
+    return by_commit
+
+
+def _latest_deploy(repo_dir, home='.', tmpdir='/tmp'):
+    with hide('running', 'stdout'):
+        hist = load_remote_git_history(get_remote_git_history_path(home, repo_dir), limit=1, tmpdir=tmpdir)
+    if not hist or not hist.repo_history(repo_dir):
+        return None
+    return hist.repo_history(repo_dir)[0]
@@ -0,0 +1,95 @@
+"""
+Shared OpenSSH connections for the local ssh-based transports (rsync, git push)
+
+Every transport started locally (e.g. the rsync of ``ensure.git.rsync``) used to do a
+full ssh handshake, through ``env.gateway`` if any. Here, one ControlMaster connection 
+is kept per user/host/port (ControlPersist, OpenSSH >= 5.6), and transports are given the 
+ssh options to reuse it. The gateway connection itself is a multiplexed master too.
+
+Fabric's own connections are made by paramiko, which cannot use OpenSSH control 
+sockets; they are already kept open by fabric for the whole run.
+"""
+
+import os
+import pipes
+import getpass
+import hashlib
+from fabric.api import env, local
+from fabric.auth import get_password
+from fabric.network import normalize
+from fabric.version import get_version
+from cuisine_sweet.utils import local_run_expect
+
+
+def password_prompts(user, host, port):
+    """
+    returns the ``(prompts, answers)`` for a local ssh to user@host:port (see :func:`cuisine_sweet.utils.local_run_expect`)
+    """
+    if( get_version() >= '1.6.2' ):
+        # signature changed in this version
+        passwrd = get_password( user, host, port )
+    else:
+        passwrd = get_password()
+    prompts = [ 'Are you sure you want to continue connecting', ".* password:" ]
+    answers = [ 'yes', passwrd ]
+    return prompts, answers
+
+
+def control_path(user, host, port, local_tmpdir='/tmp'):
+    """
+    returns the path of the control socket for user@host:port (kept short, as sockets paths are limited)
+    """
+    digest = hashlib.sha1('%s@%s:%s' % (user, host, port)).hexdigest()[0:16]
+    return os.path.join(local_tmpdir, getpass.getuser(), 'deploy', 'ssh', digest)
+
+
+def ssh_options(user, host, port, check_hostkey=True, local_tmpdir='/tmp', via_gateway=True):
+    """
+    returns the ssh command-line options (a str) to connect to user@host:port through its master connection
+
+    If ``env.gateway`` is set (and ``via_gateway``), the options include the ``ProxyCommand`` through 
+    the gateway, so that a connection made after the master is gone still goes through the gateway.
+    """
+    opts = [ 
+        "-p %s" % port,
+        "-o StrictHostKeyChecking=%s" % ('yes' if check_hostkey else 'no'),
+        "-o ControlMaster=auto",
+        "-o ControlPath=%s" % control_path(user, host, port, local_tmpdir),
+        "-o ControlPersist=%d" % env.get('ssh_control_persist', 600),
+        ]
+    if via_gateway and env.gateway:
+        gateway_user, gateway_host, gateway_port = normalize(env.gateway)
+        gateway_opts = ssh_options(gateway_user, gateway_host, gateway_port, check_hostkey=check_hostkey, local_tmpdir=local_tmpdir, via_gateway=False)
+        opts.append('-o %s' % pipes.quote('ProxyCommand=ssh %s -W %%h:%%p %s@%s' % (gateway_opts, gateway_user, gateway_host)))
+    return " ".join(opts)
+
+
+def master_started(user, host, port, check_hostkey=True, local_tmpdir='/tmp', via_gateway=True):
+    """
+    Ensures that the master connection to user@host:port is up, then returns the 
+    ssh options of :func:`ssh_options`. 
+
+    The master is started (answering the password prompts) only if the control socket 
+    does not answer ``ssh -O check``; it then stays up for ``env.ssh_control_persist``
+    seconds (default 600) after its last use. If ``env.gateway`` is set, the connection 
+    goes through a (multiplexed) master connection to the gateway.
+    """
+    opts = ssh_options(user, host, port, check_hostkey=check_hostkey, local_tmpdir=local_tmpdir, via_gateway=via_gateway)
+    path = control_path(user, host, port, local_tmpdir)
+    alive = local('ssh -o ControlPath=%s -O check %s@%s 2>&1 && echo OK; true' % (path, user, host), capture=True).endswith('OK')
+    if not alive:
+        local('mkdir -p %s' % os.path.dirname(path))
+        if via_gateway and env.gateway:
+            gateway_user, gateway_host, gateway_port = normalize(env.gateway)
+            master_started(gateway_user, gateway_host, gateway_port, check_hostkey=check_hostkey, local_tmpdir=local_tmpdir, via_gateway=False)
+        cmd = 'ssh %s %s@%s true' % (opts, user, host)
+        prompts, answers = password_prompts(user, host, port)
+        local_run_expect(cmd, prompts, answers)
+    return opts
+
+
+def master_stopped(user, host, port, local_tmpdir='/tmp'):
+    """
+    Ensures that the master connection to user@host:port (if any) is closed.
+    """
+    local('ssh -o ControlPath=%s -O exit %s@%s 2>/dev/null; true' % (control_path(user, host, port, local_tmpdir), user, host))
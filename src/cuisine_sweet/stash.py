@@ -0,0 +1,73 @@
+"""
+Local stash of the artifacts used to bootstrap hosts (cpanm, supervisor, ...)
+
+Instead of every host downloading its tools from the internet (slow, and impossible
+from firewalled hosts), each artifact is fetched once into a local stash on the deploy
+box, verified by its sha256, then uploaded with ``put`` to the hosts whose copy differs.
+
+The stash is kept under ``local_tmpdir/<local user>/deploy/stash``. An artifact already
+in the stash with the right checksum is not fetched again, so the stash can also be
+pre-populated for offline deploys. If no ``sha256`` is given, the first fetched copy
+is trusted and its checksum printed, to be pinned in the fabfile.
+
+Usage::
+
+    from cuisine_sweet import stash
+
+    path = stash.uploaded('https://example.com/tool-1.0.tar.gz', '.deploy/stash', sha256='<hex digest>')
+"""
+
+import os
+import getpass
+import hashlib
+from fabric.api import local, run, put, abort, puts
+from cuisine_sweet.utils import run_once
+
+
+def stash_dir(local_tmpdir='/tmp'):
+    return os.path.join(local_tmpdir, getpass.getuser(), 'deploy', 'stash')
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    f = open(path, 'rb')
+    try:
+        for chunk in iter(lambda: f.read(1 << 20), ''):
+            digest.update(chunk)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+
+@run_once
+def fetched(url, sha256=None, name=None, local_tmpdir='/tmp'):
+    """
+    Ensures that the artifact at ``url`` is in the local stash (as ``name``, default:
+    the basename of ``url``) and matches ``sha256``, then returns its local path.
+    """
+    path = os.path.join(stash_dir(local_tmpdir), name or os.path.basename(url.rstrip('/')))
+    if os.path.exists(path) and (sha256 is None or file_sha256(path) == sha256):
+        return path
+    local('mkdir -p %s && curl -fsSL -o %s.part "%s"' % (os.path.dirname(path), path, url))
+    actual = file_sha256(path + '.part')
+    if sha256 is not None and actual != sha256:
+        local('rm -f %s.part' % path)
+        abort("Checksum mismatch for %s: expected sha256 %s, got %s" % (url, sha256, actual))
+    os.rename(path + '.part', path)
+    if sha256 is None:
+        puts("Stashed %s with sha256 %s (not pinned)" % (url, actual))
+    return path
+
+
+def uploaded(url, remote_dir, sha256=None, name=None, mode=None, local_tmpdir='/tmp'):
+    """
+    Ensures that the artifact at ``url`` (see :func:`fetched`) is in ``remote_dir``,
+    uploading it only if the remote copy is missing or differs. Returns its remote path.
+    """
+    path = fetched(url, sha256=sha256, name=name, local_tmpdir=local_tmpdir)
+    remote_path = os.path.join(remote_dir, os.path.basename(path))
+    remote_sha256 = run('sha256sum %s 2>/dev/null; true' % remote_path).split(' ')[0].strip()
+    if remote_sha256 != file_sha256(path):
+        run('mkdir -p %s' % remote_dir)
+        put(path, remote_path, mode=mode)
+    return remote_path
@@ -1,8 +1,16 @@
+import os
+import re
 import sys
+import time
+import json
+import fcntl
+import select
+import atexit
 import inspect
+import contextlib
 import pexpect
 from decorator import decorator
-from fabric.api import puts
+from fabric.api import env, puts
 from fabric.colors import green
 from fabric.utils import error
 
@@ -12,36 +20,288 @@ def this_func(level=1):
     return '%s.%s' % (mod.__name__, frm[3])
 
 
+# metrics of the ensure calls in progress (innermost last), see completed_ok()
+_ensure_stack = [ ]
+
+# metrics of all the ensure calls made in this fab run
+_ensure_metrics = [ ]
+
+
 def completed_ok(arg_output=[]):
+    """
+    Decorates an ensure function: prints a green OK line once it completes, and records its metrics.
+
+    The metrics of each call are: wall time, host, number of run/sudo/local invocations made 
+    within the call, and whether anything changed (derived from the return value). If 
+    ``env.ensure_metrics_log`` is set, they are appended to that file as JSON lines. At the 
+    end of the fab run, the slowest ``env.ensure_metrics_top`` (default 10) calls are printed.
+    """
     def wrapped_f(func, *args, **kwargs):
-        r = func(*args, **kwargs)
+        _install_invocation_counters()
+        metrics = { 
+            'ensure': '%s.%s' % (func.__module__, func.__name__), 
+            'host': env.host_string, 
+            'run': 0, 
+            'sudo': 0, 
+            'local': 0,
+            }
+        _ensure_stack.append(metrics)
+        started = time.time()
+        try:
+            r = func(*args, **kwargs)
+        except BaseException:
+            _ensure_stack.pop()
+            _record_metrics(metrics, started, ok=False)
+            raise
+        _ensure_stack.pop()
+        _record_metrics(metrics, started, changed=_changed(r))
         out = []
         for i in arg_output:
-            out.append(args[i])
+            out.append(str(args[i]))
         puts(green('%s.%s(%s): OK' % (func.__module__, func.__name__, ', '.join(out))))
         return r
     return decorator(wrapped_f) # needed to preserve: func signature, docstring, name
+
+
+def ensure_metric(name, value):
+    """
+    adds the metric ``name`` to the metrics of the innermost ensure call in progress
+    """
+    if _ensure_stack:
+        _ensure_stack[-1][name] = value
+
+
+def _changed(r):
+    if r in ('changed', 'unchanged'):
+        return r == 'changed'
+    if isinstance(r, (bool, list, tuple, dict)):
+        return bool(r)
+    return None
+
+
+def _record_metrics(metrics, started, ok=True, changed=None):
+    metrics['seconds'] = round(time.time() - started, 3)
+    metrics['ok'] = ok
+    metrics['changed'] = changed
+    metrics['time'] = started
+    if not _ensure_metrics:
+        atexit.register(_print_slowest_ensures)
+    _ensure_metrics.append(metrics)
+    if env.get('ensure_metrics_log'):
+        f = open(env.ensure_metrics_log, 'a')
+        f.write(json.dumps(metrics, sort_keys=True) + "\n")
+        f.close()
+
+
+def _print_slowest_ensures():
+    top = env.get('ensure_metrics_top', 10)
+    if not top:
+        return
+    slowest = sorted(_ensure_metrics, key=lambda m: m['seconds'], reverse=True)[0:top]
+    puts("Slowest ensures:", show_prefix=False)
+    for m in slowest:
+        flags = [ ]
+        if not m['ok']:
+            flags.append('failed')
+        elif m['changed'] is not None:
+            flags.append('changed' if m['changed'] else 'unchanged')
+        puts("  %9.3fs  %s  %s  (run=%d sudo=%d local=%d) %s" % (
+            m['seconds'], m['host'], m['ensure'], m['run'], m['sudo'], m['local'], ' '.join(flags)), show_prefix=False)
+
+
+_counters_installed = [ ]
+
+def _install_invocation_counters():
+    """
+    wraps fabric's internals once, so that every run/sudo/local (also from cuisine) is counted
+    """
+    if _counters_installed:
+        return
+    _counters_installed.append(True)
+    import fabric.operations
+    run_command = fabric.operations._run_command
+    prefix_commands = fabric.operations._prefix_commands
+
+    def counted_run_command(*args, **kwargs):
+        _count_invocation('sudo' if kwargs.get('sudo') else 'run')
+        return run_command(*args, **kwargs)
+
+    def counted_prefix_commands(command, which):
+        if which == 'local':
+            _count_invocation('local')
+        return prefix_commands(command, which)
+
+    fabric.operations._run_command = counted_run_command
+    fabric.operations._prefix_commands = counted_prefix_commands
+
+
+def _count_invocation(kind):
+    for metrics in _ensure_stack:
+        metrics[kind] += 1
+
+
+# results of the run_once functions called so far in this fab process
+_run_once_results = { }
+
+
+def run_once(func):
+    """
+    Decorates a local-only function, so that it runs at most once per fab process for the 
+    same arguments (e.g. path and refspec), instead of once per host. Later calls return the 
+    result of the first one. Calls that raise (or abort) are not remembered.
+    """
+    def wrapped_f(func, *args, **kwargs):
+        key = (func.__module__, func.__name__, args, tuple(sorted(kwargs.items())))
+        if key not in _run_once_results:
+            _run_once_results[key] = func(*args, **kwargs)
+        return _run_once_results[key]
+    return decorator(wrapped_f)(func)
         
 
-def local_run_expect(cmd, prompts, answers, logfile=sys.stdout):
-    puts(cmd)
-    child = pexpect.spawn(
-        cmd,
-        timeout=1800,
-        )
-    child.logfile = logfile
-    child.delaybeforesend = 0
-    while True:
+@contextlib.contextmanager
+def local_lock(path):
+    """
+    Context manager holding an exclusive ``flock`` on the local file ``path`` (created if 
+    needed), so that concurrent fab processes (e.g. the workers of 
+    :func:`cuisine_sweet.executor.execute`) do not work on the same local files at once.
+    """
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.isdir(dirname):
         try:
-            i = child.expect(prompts)
-            if i <= len(answers)-1:
-                child.sendline(answers[i])
-        except pexpect.EOF:
-            break
-    child.close()
-    success = False
-    if child.exitstatus is not None:
-        if child.exitstatus == 0:
-            success = True
-    if not success:
-        error("Error in rsync subprocess: exit_code=%s; signal=%s" % (child.exitstatus, child.signalstatus))
+            os.makedirs(dirname)
+        except OSError:
+            if not os.path.isdir(dirname):
+                raise
+    f = open(path, 'a')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+    finally:
+        f.close()
+
+
+def local_run_expect(cmd, prompts, answers, logfile=sys.stdout, timeout=None):
+    """
+    Runs the local ``cmd``, answering its ``prompts`` (regexes) with the corresponding ``answers``.
+
+    The output is logged to ``logfile`` and returned. The ``timeout`` (seconds) defaults to 
+    ``env.local_run_expect_timeout`` or 1800. Errors out if ``cmd`` fails or times out.
+    """
+    puts(cmd)
+    children = _expect_children_run([ ('local', cmd, prompts, answers, logfile) ], timeout)
+    exitstatus, signalstatus, output = children['local']
+    if exitstatus != 0:
+        error("Error in rsync subprocess: exit_code=%s; signal=%s" % (exitstatus, signalstatus))
+    return output
+
+
+def local_run_expect_many(jobs, log_dir=None, timeout=None):
+    """
+    Runs many local commands at once, answering the prompts of each (see :func:`local_run_expect`).
+
+    :param jobs: *required* list; of ``(name, cmd, prompts, answers)``, e.g. one per host
+    :param log_dir: str; if given, the output of each job is logged to ``log_dir/name.log``, 
+        otherwise to stdout, prefixed by ``[name]``. Defaults to ``env.local_run_expect_log_dir``.
+    :param timeout: int; seconds allowed for each job, defaults to ``env.local_run_expect_timeout`` or 1800
+
+    All children are supervised from a single poll loop. Returns a dict of
+    name -> ``(exitstatus, signalstatus, output)``; errors out if any of them failed.
+    """
+    if log_dir is None:
+        log_dir = env.get('local_run_expect_log_dir')
+    if log_dir and not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+    specs = [ ]
+    for name, cmd, prompts, answers in jobs:
+        puts("[%s] %s" % (name, cmd), show_prefix=False)
+        if log_dir:
+            logfile = open(os.path.join(log_dir, '%s.log' % name), 'a')
+        else:
+            logfile = _PrefixedLog(sys.stdout, name)
+        specs.append((name, cmd, prompts, answers, logfile))
+    children = _expect_children_run(specs, timeout)
+    if log_dir:
+        for spec in specs:
+            spec[4].close()
+    failed = [ '%s (exit_code=%s; signal=%s)' % (name, c[0], c[1]) for name, c in sorted(children.items()) if c[0] != 0 ]
+    if failed:
+        error("Error in subprocess: %s" % ', '.join(failed))
+    return children
+
+
+class _PrefixedLog(object):
+
+    def __init__(self, stream, name):
+        self.stream = stream
+        self.prefix = '[%s] ' % name
+        self.at_line_start = True
+
+    def write(self, data):
+        for line in data.splitlines(True):
+            if self.at_line_start:
+                self.stream.write(self.prefix)
+            self.stream.write(line)
+            self.at_line_start = line.endswith("\n")
+
+    def flush(self):
+        self.stream.flush()
+
+
+def _expect_children_run(specs, timeout=None):
+    """
+    spawns a pexpect child per ``(name, cmd, prompts, answers, logfile)`` spec, and supervises 
+    all of them in one non-blocking poll loop; returns a dict of name -> (exitstatus, signalstatus, output)
+    """
+    if timeout is None:
+        timeout = env.get('local_run_expect_timeout', 1800)
+    children = { }
+    for name, cmd, prompts, answers, logfile in specs:
+        child = pexpect.spawn(cmd, timeout=None)
+        child.delaybeforesend = 0
+        children[child.child_fd] = {
+            'name': name,
+            'child': child,
+            'prompts': [ re.compile(p, re.DOTALL) for p in prompts ],
+            'answers': answers,
+            'logfile': logfile,
+            'buffer': '',
+            'output': [ ],
+            'deadline': time.time() + timeout,
+            }
+    results = { }
+    while children:
+        ready = select.select(children.keys(), [ ], [ ], 0.5)[0]
+        for fd in ready:
+            c = children[fd]
+            try:
+                data = c['child'].read_nonblocking(4096, timeout=0)
+            except pexpect.TIMEOUT:
+                continue
+            except pexpect.EOF:
+                results[c['name']] = _expect_child_closed(c)
+                del children[fd]
+                continue
+            c['logfile'].write(data)
+            c['logfile'].flush()
+            c['output'].append(data)
+            c['buffer'] += data
+            for i, prompt in enumerate(c['prompts']):
+                if prompt.search(c['buffer']):
+                    if i <= len(c['answers'])-1:
+                        c['child'].sendline(c['answers'][i])
+                    c['buffer'] = ''
+                    break
+            c['buffer'] = c['buffer'][-4096:]
+        now = time.time()
+        for fd, c in children.items():
+            if now > c['deadline']:
+                c['logfile'].write("\nTimeout after %ss\n" % timeout)
+                c['child'].terminate(force=True)
+                results[c['name']] = _expect_child_closed(c)
+                del children[fd]
+    return results
+
+
+def _expect_child_closed(c):
+    c['child'].close()
+    return (c['child'].exitstatus, c['child'].signalstatus, ''.join(c['output']))
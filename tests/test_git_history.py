@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import datetime
+import subprocess
+import unittest
+
+from fabric.operations import _shell_escape
+from cuisine_sweet import git
+
+
+class HistoryAppendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.home = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.home)
+
+    def remote_run(self, cmd):
+        # wrapped the same way as fabric's run()
+        return subprocess.check_output('/bin/bash -l -c "%s"' % _shell_escape(cmd), shell=True, cwd=self.home)
+
+    def entry(self, commit_hash, title, timestamp=1234567890.5):
+        return [ timestamp, [ 'git@example.com:repo.git', 'master', 'repo' ], {
+            'commit_hash': commit_hash,
+            'parents': [ 'b' * 40 ],
+            'author': 'A U Thor <a@example.com>',
+            'date': datetime.datetime(2013, 1, 2, 3, 4, 5),
+            'title': title,
+            'message_body': [ 'line with \\ backslash', 'and "quotes"' ],
+            'shipped': [ [ commit_hash, title ] ],
+            } ]
+
+    def append(self, path, entry):
+        hist = git.GitHistory()
+        return self.remote_run(git.history_append_cmd(path, hist.dump_entry(entry), replace_commit=entry[2]['commit_hash']))
+
+    def test_roundtrip_quotes_and_backslashes(self):
+        title = 'Revert "fix \\"quoted\\" path C:\\\\tmp\\n" $HOME `id` \'single\''
+        entry = self.entry('a' * 40, title)
+        path = os.path.join('.deploy', 'git', 'history', 'repo.jsonl')
+        self.append(path, self.entry('c' * 40, 'previous'))
+        self.append(path, entry)
+
+        lines = open(os.path.join(self.home, path)).read().splitlines()
+        self.assertEqual(len(lines), 2)
+        loaded = git.GitHistory()
+        loaded.load_entries(lines)
+        latest = loaded.repo_history('repo')[0]
+        self.assertEqual(latest[2]['title'], title)
+        self.assertEqual(latest[2]['message_body'], entry[2]['message_body'])
+        self.assertEqual(latest[2]['date'], entry[2]['date'])
+        self.assertEqual(latest[2]['shipped'], [ [ 'a' * 40, title ] ])
+
+    def test_redeploy_replaces_last_entry(self):
+        path = os.path.join('.deploy', 'git', 'history', 'repo.jsonl')
+        self.append(path, self.entry('c' * 40, 'previous'))
+        self.append(path, self.entry('a' * 40, 'latest', timestamp=1))
+        output = self.append(path, self.entry('a' * 40, 'latest', timestamp=2))
+
+        self.assertTrue('REPLACED' in output.splitlines())
+        loaded = git.GitHistory()
+        loaded.load_entries(open(os.path.join(self.home, path)).read().splitlines())
+        self.assertEqual([ (e[0], e[2]['commit_hash']) for e in loaded.repo_history('repo') ], [ (2, 'a' * 40), (1234567890.5, 'c' * 40) ])
+
+
+class LogLatestTest(unittest.TestCase):
+
+    def log(self, commit_hash, title):
+        return "\0".join([ commit_hash, 'b' * 40, 'A U Thor <a@example.com>', '1357095845', title, '' ]) + "\0"
+
+    def test_same_commit_updates_timestamp(self):
+        hist = git.GitHistory()
+        first = hist.log_latest('git@example.com:repo.git', 'master', 'repo', self.log('a' * 40, 'first'))
+        first[0] = 0
+        again = hist.log_latest('git@example.com:repo.git', 'master', 'repo', self.log('a' * 40, 'first'))
+        self.assertTrue(again is first)
+        self.assertTrue(again[0] > 0)
+        self.assertEqual(len(hist.repo_history('repo')), 1)
+        hist.log_latest('git@example.com:repo.git', 'master', 'repo', self.log('c' * 40, 'second'))
+        self.assertEqual([ e[2]['commit_hash'] for e in hist.repo_history('repo') ], [ 'c' * 40, 'a' * 40 ])
+
+
+if __name__ == '__main__':
+    unittest.main()